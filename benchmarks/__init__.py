@@ -0,0 +1 @@
+'''offline benchmarks, see benchmarks/run.py'''
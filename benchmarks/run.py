@@ -0,0 +1,304 @@
+'''offline benchmark suite for the hot paths of the package.
+
+Every scenario runs against local stand-ins only: AlpacaStub serves
+Alpaca daily bars and saved Seeking Alpha pages, and MongoDB is either
+a local mongod (default) or mongomock ("--mongo memory").
+Reports docs/sec, p50/p99 latency of a unit of work and peak Python memory.
+Each scenario times only the work it measures, fixtures (sample articles, bars,
+inserted documents) are built before its timer starts.
+
+Usage:
+    python -m benchmarks.run [--docs 500] [--latency 0.05] [--error-rate 0.02]
+                             [--mongo mongodb://localhost:27017] [--only quotes label]
+                             [--json results.json]
+'''
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+import threading
+import tracemalloc
+from datetime import datetime, timedelta
+from queue import Queue
+from threading import Thread, Lock, Condition
+
+import numpy as np
+
+from benchmarks.stubs import AlpacaStub, PAGES, daily_bars, mongo_client
+
+TICKERS = ['AAPL', 'TSLA', 'XOM', 'BA', 'NFLX', 'PFE', 'INTC', 'WMT', 'NVDA', 'F']
+INVALID = ['ZZZZ']
+FIELD = 'EVENT_STUDY'
+DB = 'data_digger_bench'
+COLLECTION = 'articles'
+
+
+def sample_articles(n, seed=0):
+    '''builds n synthetic articles published on weekdays during regular trading hours'''
+    rnd = random.Random(seed)
+    start = datetime(2020, 6, 1)
+    docs = []
+    while len(docs) < n:
+        date = start + timedelta(days=rnd.randint(0, 180), hours=rnd.randint(10, 14), minutes=rnd.randint(0, 59))
+        if date.isoweekday() > 5:
+            continue
+        t1, t2 = rnd.sample(TICKERS + INVALID, 2)
+        text = (f'Shares of {t1} (NASDAQ:{t1}) {rnd.uniform(-5, 5):+.1f}% after the company '
+                f'raised its outlook. Peer {t2} (NYSE:{t2}) also moved.Analysts expect '
+                f'more volatility in the coming weeks. ' * rnd.randint(1, 3))
+        docs.append({'title': f'{t1} moves', 'url': f'https://seekingalpha.com/news/{len(docs)}',
+                     'time': date, 'article': text})
+    return docs
+
+
+def handler_for(client):
+    '''returns a MongoHandler working on a fresh benchmark collection'''
+    from data_digger.Mongo_module import MongoHandler
+    client[DB].drop_collection(COLLECTION)
+    client[DB].drop_collection(f'{COLLECTION}_meta')
+    return MongoHandler(FIELD, client=client, db=DB, collection=COLLECTION)
+
+
+def quotes(opts, client):
+    '''--quotes: one producer claiming documents and ten consumers calling Alpaca'''
+    handler = handler_for(client)
+    handler.db[COLLECTION].insert_many(sample_articles(opts.docs))
+    latencies = []
+    process_item = handler.process_item
+
+    def timed(*args):
+        t = time.perf_counter()
+        process_item(*args)
+        latencies.append(time.perf_counter() - t)
+    handler.process_item = timed
+
+    q = []
+    lock = Lock()
+    full_, empty_ = Condition(lock), Condition(lock)
+    threads = [Thread(target=handler.find_item, args=(q, full_, empty_), daemon=True)]
+    threads += [Thread(target=handler.updater, args=(q, full_, empty_), daemon=True) for l in range(10)]
+    started = time.perf_counter()
+    run_threads(threads, opts.timeout)
+    elapsed = time.perf_counter() - started
+    # find_item logs its errors and stops the consumers, so a failed producer shows up here
+    if len(latencies) < opts.docs:
+        raise RuntimeError(f'only {len(latencies)} of {opts.docs} documents processed, see the log')
+    return opts.docs, elapsed, latencies
+
+
+def sweeper(opts, client):
+    '''--sweeper: binning the whole corpus and ten deleting threads'''
+    from data_digger.stack.misc_functions import collect_bins, deleter, is_short
+    from data_digger.records import Article
+    handler = handler_for(client)
+    handler.db[COLLECTION].insert_many(sample_articles(opts.docs))
+    started = time.perf_counter()
+    bins = collect_bins(handler.db, COLLECTION)
+    latencies = [time.perf_counter() - started]
+    # unbounded, so that a failed deleter cannot block the producer
+    q = Queue()
+    workers = [Thread(target=deleter, args=(q, bins, handler.db, COLLECTION), daemon=True) for l in range(10)]
+    for i in handler.db[COLLECTION].find({}, {'article': 1}, batch_size=1000):
+        q.put(Article(i['_id'], None, i['article']))
+    for w in workers:
+        q.put(None)
+    run_threads(workers, opts.timeout)
+    elapsed = time.perf_counter() - started
+    for i in handler.db[COLLECTION].find():
+        t = time.perf_counter()
+        is_short(i['article'], bins)
+        latencies.append(time.perf_counter() - t)
+    return opts.docs, elapsed, latencies
+
+
+def label(opts, client):
+    '''--label: a full "$out" rebuild followed by an incremental "$merge" run'''
+    from data_digger.Alpaca import Alpaca
+    handler = handler_for(client)
+    docs = sample_articles(opts.docs)
+    inst = Alpaca()
+    for d in docs:
+        d[FIELD] = [inst.OLS_method(*bars_for(t, d['time']), t) for t in TICKERS[:2]]
+        d[handler.stamp] = datetime.utcnow()
+    handler.db[COLLECTION].insert_many(docs)
+    latencies = []
+    for incremental in (False, True):
+        t = time.perf_counter()
+        handler.labelling(incremental=incremental, target='bench_labels')
+        latencies.append(time.perf_counter() - t)
+    return opts.docs*2, sum(latencies), latencies
+
+
+def bars_for(ticker, date):
+    '''builds "before" and "after" bars the way Alpaca API returns them'''
+    before = {s: daily_bars(s, (date - timedelta(days=60)).date(), date.date())[-30:] for s in (ticker, 'SPY')}
+    after = {s: daily_bars(s, date.date(), (date + timedelta(days=1)).date()) for s in (ticker, 'SPY')}
+    return before, after
+
+
+def parse_item(opts, client):
+    '''HARSpider.parse_item over saved listing pages fetched from the stub'''
+    import urllib.request
+    from scrapy.http import HtmlResponse, Request
+    from data_digger.stack.spider.HAR_crawler import HARSpider
+    url = f'{opts.stub.url}/market-news/all'
+    body = urllib.request.urlopen(url).read()
+    # __init__ adjusts Scrapy logging handlers, which are not installed here
+    spider = HARSpider.__new__(HARSpider)
+    spider.timeout, spider.next_url = 60, None
+    responses = [HtmlResponse(url=url, body=body, encoding='utf-8', request=Request(url))
+                 for l in range(max(1, opts.docs // 20))]
+    latencies, items = [], 0
+    for response in responses:
+        t = time.perf_counter()
+        items += sum(1 for i in spider.parse_item(response))
+        latencies.append(time.perf_counter() - t)
+    return items, sum(latencies), latencies
+
+
+def ticker_extraction(opts, client):
+    '''misc_functions.ticker_extraction over synthetic and saved articles'''
+    from data_digger.stack.misc_functions import ticker_extraction
+    texts = [d['article'] for d in sample_articles(opts.docs)]
+    latencies = []
+    for text in texts:
+        t = time.perf_counter()
+        ticker_extraction(text)
+        latencies.append(time.perf_counter() - t)
+    return len(texts), sum(latencies), latencies
+
+
+def ols_method(opts, client):
+    '''Alpaca.OLS_method over synthetic bars'''
+    from data_digger.Alpaca import Alpaca
+    inst = Alpaca()
+    inputs = [(bars_for(t, d['time']), t) for d in sample_articles(opts.docs) for t in TICKERS[:1]]
+    latencies = []
+    for (before, after), ticker in inputs:
+        t = time.perf_counter()
+        inst.OLS_method(before, after, ticker)
+        latencies.append(time.perf_counter() - t)
+    return len(inputs), sum(latencies), latencies
+
+
+# scenarios relying on $$NOW, pipeline updates or $merge, which mongomock lacks
+MONGOD_ONLY = {'quotes', 'label'}
+
+
+def run_threads(threads, timeout):
+    '''starts threads and waits for them to finish.
+
+       Raises:
+           the first exception raised in any of the threads, as soon as it is raised
+           TimeoutError: an error occured if the threads are still running after timeout seconds
+    '''
+
+    errors = []
+    hook = threading.excepthook
+    threading.excepthook = lambda args: errors.append(args.exc_value)
+    try:
+        for t in threads:
+            t.start()
+        deadline = time.monotonic() + timeout
+        while any(t.is_alive() for t in threads):
+            if errors:
+                raise errors[0]
+            if time.monotonic() > deadline:
+                raise TimeoutError(f'threads still running after {timeout} s')
+            next(t for t in threads if t.is_alive()).join(0.1)
+        if errors:
+            raise errors[0]
+    finally:
+        threading.excepthook = hook
+
+
+SCENARIOS = {
+    'quotes': quotes,
+    'sweeper': sweeper,
+    'label': label,
+    'parse_item': parse_item,
+    'ticker_extraction': ticker_extraction,
+    'OLS_method': ols_method,
+}
+
+
+def run(name, func, opts, client):
+    '''runs a scenario and summarizes its results.
+
+       A scenario returns the number of documents processed, the seconds its measured work took
+       and the latencies of the units of work. Throughput is computed from the measured seconds,
+       the total, fixtures included, is reported as "wall_seconds".
+    '''
+    if opts.mongo == 'memory' and name in MONGOD_ONLY:
+        return {'scenario': name, 'skipped': 'needs a real mongod'}
+    if opts.memory:
+        tracemalloc.start()
+    t = time.perf_counter()
+    try:
+        docs, elapsed, latencies = func(opts, client)
+    except Exception as e:
+        # some messages (NLTK missing data) span many lines
+        return {'scenario': name, 'error': f"{type(e).__name__}: {' '.join(str(e).split())[:200]}"}
+    finally:
+        wall = time.perf_counter() - t
+        peak = tracemalloc.get_traced_memory()[1] if opts.memory else None
+        tracemalloc.stop()
+    lat = np.array(latencies) * 1000 if latencies else np.zeros(1)
+    return {'scenario': name, 'docs': docs, 'seconds': round(elapsed, 3), 'wall_seconds': round(wall, 3),
+            'docs_per_sec': round(docs / elapsed, 1),
+            'p50_ms': round(float(np.percentile(lat, 50)), 3),
+            'p99_ms': round(float(np.percentile(lat, 99)), 3),
+            'peak_mb': round(peak / 2**20, 2) if peak is not None else None}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--docs', type=int, default=500, help='documents per scenario')
+    parser.add_argument('--latency', type=float, default=0.05, help='stub API latency, seconds')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of stub API requests answered with 429')
+    parser.add_argument('--mongo', help='MongoDB URI of a local mongod, or "memory" for mongomock')
+    parser.add_argument('--only', nargs='+', choices=SCENARIOS, help='scenarios to run')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='skip tracemalloc, which slows down CPU-bound scenarios')
+    parser.add_argument('--timeout', type=float, default=600,
+                        help='seconds a threaded scenario may run before it is reported as failed')
+    parser.add_argument('--json', help='a file to write the results to')
+    opts = parser.parse_args(argv)
+
+    from data_digger.Alpaca import Alpaca
+    opts.stub = AlpacaStub(latency=opts.latency, error_rate=opts.error_rate, invalid=INVALID)
+    Alpaca.base_url = opts.stub.start()
+    Alpaca.key = Alpaca.s_key = 'bench'
+    client = mongo_client(opts.mongo)
+    results = []
+    try:
+        for name in opts.only or SCENARIOS:
+            res = run(name, SCENARIOS[name], opts, client)
+            results.append(res)
+            print(json.dumps(res), file=sys.stderr)
+    finally:
+        try:
+            client.drop_database(DB)
+        except Exception as e:
+            print(f'benchmark database not dropped: {e}', file=sys.stderr)
+        opts.stub.stop()
+
+    print(f"\n{'scenario':<18}{'docs':>7}{'docs/sec':>11}{'p50 ms':>10}{'p99 ms':>10}{'peak MB':>9}")
+    for r in results:
+        if 'error' in r:
+            print(f"{r['scenario']:<18} failed: {r['error']}")
+        elif 'skipped' in r:
+            print(f"{r['scenario']:<18} skipped: {r['skipped']}")
+        else:
+            print(f"{r['scenario']:<18}{r['docs']:>7}{r['docs_per_sec']:>11}{r['p50_ms']:>10}"
+                  f"{r['p99_ms']:>10}{r['peak_mb'] if r['peak_mb'] is not None else '-':>9}")
+    if opts.json:
+        with open(opts.json, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
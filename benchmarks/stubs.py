@@ -0,0 +1,142 @@
+'''local stand-ins for the services the package talks to:
+
+    * AlpacaStub - an aiohttp server mimicking Alpaca v1/bars/day endpoint
+      and serving saved Seeking Alpha listing pages
+    * mongo_client - a local MongoDB client or an in-memory mongomock one
+'''
+
+import asyncio
+import random
+import threading
+import zlib
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+from urllib.parse import parse_qs
+
+from aiohttp import web
+
+PAGES = Path(__file__).parent / 'pages'
+EASTERN = timezone(timedelta(hours=-4))
+
+
+def daily_bars(symbol, first, last):
+    '''builds deterministic daily bars of a random walk for each weekday
+       between two dates. Bar timestamps are midnights US/Eastern, as in Alpaca responses.
+
+       Args:
+           symbol: a string stock ticker seeding the walk
+           first, last: date objects limiting the bars (inclusive)
+
+       Returns:
+           a list of dicts with daily bar values
+    '''
+
+    bars = []
+    day = first
+    while day <= last:
+        if day.isoweekday() <= 5:
+            t = int(datetime(day.year, day.month, day.day, tzinfo=EASTERN).timestamp())
+            rnd = random.Random(zlib.crc32(f'{symbol}{t}'.encode()))
+            c = 100 + (zlib.crc32(symbol.encode()) % 200) + rnd.uniform(-5, 5)
+            bars.append({'t': t, 'o': round(c*0.99, 2), 'h': round(c*1.01, 2),
+                         'l': round(c*0.98, 2), 'c': round(c, 2), 'v': rnd.randint(10**5, 10**7)})
+        day += timedelta(days=1)
+    return bars
+
+
+class AlpacaStub:
+    '''an aiohttp server run in a background thread.
+
+       Attributes:
+           latency: a float number of seconds each bars request is delayed by
+           error_rate: a float share of bars requests answered with 429 Too Many Requests
+           invalid: a set of tickers no bars are returned for
+           requests: an integer number of bars requests served
+           url: a base URL string of the running server
+    '''
+
+    def __init__(self, latency=0.0, error_rate=0.0, invalid=(), seed=0):
+        '''Inits AlpacaStub'''
+        self.latency = latency
+        self.error_rate = error_rate
+        self.invalid = set(invalid)
+        self.requests = 0
+        self.url = None
+        self._random = random.Random(seed)
+        self._ready = threading.Event()
+        self._loop = None
+        self._runner = None
+
+    async def bars(self, request):
+        '''answers a v1/bars/day request'''
+        self.requests += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if self._random.random() < self.error_rate:
+            return web.Response(status=429, text='too many requests')
+        query = {k: v[0] for k, v in parse_qs(request.query_string, keep_blank_values=True).items()}
+        symbols = query['symbols'].split(',')
+        if 'until' in query:
+            last = datetime.fromisoformat(query['until']).date()
+            limit = int(query.get('limit', 100))
+            first = last - timedelta(days=limit*2)
+        else:
+            first = datetime.fromisoformat(query['start']).date()
+            last = datetime.fromisoformat(query['end']).date()
+            limit = None
+        res = {}
+        for s in symbols:
+            bars = [] if s in self.invalid else daily_bars(s, first, last)
+            res[s] = bars[-limit:] if limit else bars
+        return web.json_response(res)
+
+    async def page(self, request):
+        '''serves a saved Seeking Alpha listing page'''
+        name = request.match_info.get('name', 'market-news')
+        path = PAGES / f'{name}.html'
+        if not path.exists():
+            raise web.HTTPNotFound()
+        return web.Response(body=path.read_bytes(), content_type='text/html')
+
+    def start(self, host='127.0.0.1', port=0):
+        '''starts the server in a daemon thread and returns its base URL'''
+        threading.Thread(target=self._serve, args=(host, port), daemon=True).start()
+        self._ready.wait()
+        return self.url
+
+    def _serve(self, host, port):
+        self._loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self._loop)
+        app = web.Application()
+        app.router.add_get('/v1/bars/day', self.bars)
+        app.router.add_get('/market-news/all', self.page)
+        app.router.add_get('/pages/{name}', self.page)
+        self._runner = web.AppRunner(app)
+        self._loop.run_until_complete(self._runner.setup())
+        site = web.TCPSite(self._runner, host, port)
+        self._loop.run_until_complete(site.start())
+        port = self._runner.addresses[0][1]
+        self.url = f'http://{host}:{port}'
+        self._ready.set()
+        self._loop.run_forever()
+
+    def stop(self):
+        '''stops the server'''
+        if self._loop is not None:
+            asyncio.run_coroutine_threadsafe(self._runner.cleanup(), self._loop).result()
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+
+def mongo_client(uri=None):
+    '''returns a MongoClient connected to a local mongod,
+       or an in-memory mongomock client if uri is "memory".
+
+       Server-side features such as $merge, $$NOW and pipeline updates
+       are not available in mongomock, so the scenarios relying on them need a real mongod.
+    '''
+
+    if uri == 'memory':
+        import mongomock
+        return mongomock.MongoClient()
+    from data_digger.connection import get_client
+    return get_client(uri or 'mongodb://localhost:27017')
@@ -20,18 +20,16 @@ import logging
 import os
 import numpy as np 
 import sys 
+import time
 import operator
 from dotenv import load_dotenv, find_dotenv
 from pathlib import Path
+from data_digger import metrics
+from data_digger.price_store import PriceStore
 
 #load environment variables
 load_dotenv(find_dotenv('env.env'))
 
-logging.basicConfig(
-        format="%(asctime)s %(levelname)s:%(name)s: %(message)s",
-        level=logging.DEBUG,
-        datefmt="%H:%M:%S",
-    )
 logger = logging.getLogger("debugger")
 
 
@@ -40,6 +38,7 @@ class Alpaca:
     
     Atributes:
         key, s_key: API keys stored in a .env file
+        base_url: Alpaca market data URL, may be overridden with APCA-API-DATA-URL environment variable
         open_hour, open_minute, close_hour, close_minute: integers used to define NYSE regular trading hours
         nyse, early: calendar values returned by pandas_market_calendars methods 
         returns: a string variable used as a class output name
@@ -47,10 +46,13 @@ class Alpaca:
         weekday: an integer representation of weekday when an article was published  
         weekend: a boolean indicating ehether a weekday is weekend or not
         loop: asyncio loop running http requests 
+        price_store: a PriceStore instance quotes are read from instead of the API, 
+                     opened from PRICE_STORE environment variable if set
     '''
     
     key = os.getenv ('APCA-API-KEY-ID')
     s_key = os.getenv ('APCA-API-SECRET-KEY')
+    base_url = os.getenv ('APCA-API-DATA-URL', 'https://data.alpaca.markets')
     
     open_hour = 9
     open_minute = 30
@@ -59,6 +61,7 @@ class Alpaca:
     nyse = mcal.get_calendar('NYSE')
     early = nyse.holidays()
     returns= 'abnormal returns'
+    price_store = PriceStore(os.environ['PRICE_STORE']) if os.getenv('PRICE_STORE') else None
     
     def __init__(self): 
         '''Inits Alpaca class'''
@@ -157,21 +160,28 @@ class Alpaca:
             count = 0
             while pending and count<=5:
                 count+=1
+                started = time.perf_counter()
                 done, pending = await asyncio.wait (pending, return_when=asyncio.FIRST_EXCEPTION)
+                metrics.api_latency.observe(time.perf_counter()-started)
                 for d in done:
                     if d.exception():
-                        logger.info(f'An exception {d.exception()}, retrying...')
+                        logger.info('An exception %s, retrying...', d.exception())
+                        metrics.api_requests.inc(outcome='error')
+                        metrics.api_retries.inc()
                         pending.add(d)
                         await asyncio.sleep(2)
                     else:
                         try:
                             res1 = await d.result().json()
                         except Exception as e: 
+                            metrics.api_requests.inc(outcome='bad_response')
                             logger.info("An error occurred at find_quote %s", e)  
                         else:
                             if res1[ticker] ==[]:
+                                metrics.api_requests.inc(outcome='invalid_ticker')
                                 raise ValueError('invalid ticker!' +ticker)
                             else:
+                                metrics.api_requests.inc(outcome='ok')
                                 return res1
                          
     
@@ -179,7 +189,8 @@ class Alpaca:
         '''an entry point method for making API requests
            intended to be an interface for other modules.
            
-           Historical data received with an API response is processed further
+           Historical data received with an API response (or read from the local
+           price store, if any) is processed further
            in the executor and only then returned by the method. 
            Logs the exception if two time series submitted to the executor
            are of different length. This happens if the number of 
@@ -210,13 +221,16 @@ class Alpaca:
             except Exception as e:
                 raise ValueError ('invalid date format'+ str(self.date))
             else:
-                urls = [f'https://data.alpaca.markets/v1/bars/day?symbols={ticker},SPY&limit=30&{param1}={start}',
-                    f'https://data.alpaca.markets/v1/bars/day?symbols={ticker},SPY&{param2}={start}&{param3}={end}']
-            
-                task1, task2 = [asyncio.ensure_future(
-                            self.find_quote (session, url, ticker)) for url in urls]
                 try:
-                    before, after = await asyncio.gather (task1, task2)
+                    if self.price_store is not None:
+                        before, after = self.price_store.event_windows(
+                            ticker, *[datetime.fromisoformat(d).date() for d in (start, end)])
+                    else:
+                        urls = [f'{self.base_url}/v1/bars/day?symbols={ticker},SPY&limit=30&{param1}={start}',
+                            f'{self.base_url}/v1/bars/day?symbols={ticker},SPY&{param2}={start}&{param3}={end}']
+                        task1, task2 = [asyncio.ensure_future(
+                                    self.find_quote (session, url, ticker)) for url in urls]
+                        before, after = await asyncio.gather (task1, task2)
                 except Exception as e:
                     logger.info("An error occurred while requesting quotes %s", e)  
                 else:
@@ -224,7 +238,7 @@ class Alpaca:
                     try: 
                         ts = await self.loop.run_in_executor(None, partial(self.OLS_method, before, after, ticker)) # now wait for OLS regression
                     except Exception as e:
-                        logger.exception ("An error occurred while processing results: %s", e)  
+                        logger.warning ("An error occurred while processing results for %s: %s", ticker, e)  
                     else:
                         return ts
                     
@@ -247,7 +261,8 @@ class Alpaca:
          Returns:
             a dict mapping string keys to the given ticker and
             calculated alpha, beta and abnormal return values. 
-            'Event_window' key stores ticker returns exhibited after the publication.
+            'Event_window' key stores ticker close prices exhibited after the publication
+            as parallel arrays of integer unix timestamps ('t') and float closes ('c').
         '''
         def rets (x):
             return (np.diff(x)/x[:-1])*100
@@ -273,9 +288,10 @@ class Alpaca:
                   'alpha':alpha,
                   'beta':beta[0,1], 
                    self.returns: CAR,
-                  'event_window':[ 
-                                {str(datetime.fromtimestamp(i['t'])):i['c']} for i in after[ticker]
-                            ]}
+                  'event_window':{ 
+                                't': [int(i['t']) for i in after[ticker]],
+                                'c': [float(i['c']) for i in after[ticker]]
+                            }}
     
                                  
 
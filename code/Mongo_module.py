@@ -27,21 +27,22 @@ import pymongo
 import dns
 import logging
 import time 
+import socket
+import uuid
 
 from datetime import datetime
 from functools import partial 
+from itertools import chain
 from dotenv import load_dotenv, find_dotenv
 from data_digger.stack.misc_functions import * 
 import data_digger.Alpaca as alp
+from data_digger import metrics
+from data_digger.connection import get_client
+from data_digger.records import Article
 
 # load environment variables
 load_dotenv(find_dotenv('env.env'))    
 
-logging.basicConfig(
-        format="%(asctime)s %(levelname)s:%(name)s: %(message)s",
-        level=logging.INFO,
-        datefmt="%H:%M:%S",
-        )
 logger = logging.getLogger("debugger")
 
 class MongoHandler:
@@ -50,30 +51,60 @@ class MongoHandler:
         Attributes:
             collection: a string name of Mongo collection 
                         where the scraped data is stored
-            client: a MongoClient instance
+            client: a MongoClient instance shared by the process
             db: a pymongo.database instance
             field: a string name of a database field 
                     with historical stock quotes
+            stamp: a string name of a database field storing the time
+                    the quotes field was last updated
+            meta: a pymongo.collection instance keeping run bookkeeping
+                    (last labelling run, etc.)
+            label_target: a string name of the collection labels are written to
+            events: a pymongo.collection instance with one row per (article, ticker) event,
+                    kept up to date by db_inserter
+            label_threshold: a float absolute value of abnormal returns (in per cents)
+                    above which an article is labelled with '1'
+            owner: a string identifying this process in document leases
+            lease_ttl: an integer number of seconds a lease is valid without a heartbeat
+            lease_retry: an integer number of seconds a processed document
+                    without quotes is not claimed again
         '''
         
-        def __init__(self, field):
+        def __init__(self, field, client=None, db=None, collection=None):
             '''inits MongoHandler class
             
             Args:
                 field: a string variable assigned by the user.
                 It is assumed that the same field name is used
                 each time historical quotes are added to the collection.
+                client: an optional MongoClient-like instance, 
+                        the shared MongoClient of MONGO_URI if None
+                db, collection: optional string names overriding 
+                        MONGO_DB and MONGODB_COLLECTION environment variables
             '''
             
-            db = os.getenv('MONGO_DB')
+            db = db or os.getenv('MONGO_DB')
             uri = os.getenv('MONGO_URI')
-            self.collection = os.getenv('MONGODB_COLLECTION')
-            self.client = pymongo.MongoClient(uri)
+            self.collection = collection or os.getenv('MONGODB_COLLECTION')
+            self.client = client if client is not None else get_client(uri)
             self.db = self.client[db]
             self.field = field
+            self.stamp = field + '_updated'
+            self.meta = self.db[os.getenv('MONGODB_META_COLLECTION', f'{self.collection}_meta')]
+            self.label_target = os.getenv('LABEL_COLLECTION', 'another_collection')
+            self.label_threshold = float(os.getenv('LABEL_THRESHOLD', 2))
+            self.events = self.db[os.getenv('EVENTS_COLLECTION', f'{self.collection}_events')]
+            self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+            self.lease_ttl = int(os.getenv('LEASE_TTL', 300))
+            self.lease_retry = int(os.getenv('LEASE_RETRY_AFTER', 3600))
         
-        def crawler(self):
-            '''runs a built-in Scrapy scraper '''
+        def crawler(self, stream=False):
+            '''runs a built-in Scrapy scraper 
+            
+            Args:
+                stream: a boolean replacing the default pipeline with StreamingPipeline,
+                        which quotes and labels each article before writing it
+            '''
             try:
                 from data_digger.stack.spiders.HAR_crawler import HARSpider
                 from scrapy.crawler import CrawlerProcess
@@ -85,47 +116,201 @@ class MongoHandler:
             else:
                  settings_file_path = "data_digger.stack.settings"
                  os.environ.setdefault('SCRAPY_SETTINGS_MODULE', settings_file_path)
-                 process = CrawlerProcess(get_project_settings())
+                 settings = get_project_settings()
+                 if stream:
+                     settings.set('ITEM_PIPELINES', {'data_digger.stack.pipelines.StreamingPipeline': 300})
+                     settings.set('QUOTES_FIELD', self.field)
+                     settings.set('MONGODB_META_COLLECTION', self.meta.name)
+                     settings.set('LABEL_COLLECTION', self.label_target)
+                     settings.set('LABEL_THRESHOLD', self.label_threshold)
+                     settings.set('EVENTS_COLLECTION', self.events.name)
+                 process = CrawlerProcess(settings)
                  process.crawl(HARSpider)
                  process.start()
                     
                     
-        def find_item(self, q,full, empty, maxsize=None):
-            '''makes an iterable from database documents
+        def claim_batch(self, size, match=None, takeover=None):
+            '''atomically leases a batch of documents without quotes to this process.
+            
+            A document is free if it was never leased or its lease has expired.
+            Near duplicates linked to an original article are never claimed.
+            Candidates are read first and then leased with a conditional update,
+            so that a document claimed concurrently by another worker is skipped.
+            If other workers won every candidate, the next free documents are tried,
+            so an empty result always means that no free documents are left.
+            Lease expiry is computed with the server clock ($$NOW, MongoDB 4.2+),
+            which lets workers on different hosts share the collection.
+            
+            Args:
+                size: an integer max number of documents to claim
+                match: an optional query narrowing down the documents to claim
+                takeover: an optional owner string of a crashed run,
+                          whose live leases are claimed as if they were expired
+            
+            Returns:
+                a list of Article records of the claimed documents, empty if the backlog is exhausted
+            '''
+            
+            coll = self.db[self.collection]
+            free = {self.field: {"$exists": False},
+                    "duplicate_of": {"$exists": False},
+                    "$or": [{"lease": {"$exists": False}},
+                            {"$expr": {"$lt": ["$lease.expires", "$$NOW"]}}]}
+            if takeover:
+                free["$or"].append({"lease.owner": takeover})
+            if match:
+                free = {"$and": [free, match]}
+            while True:
+                ids = [d["_id"] for d in coll.find(free, {"_id": 1}).sort("_id", 1).limit(size)]
+                if not ids:
+                    return []
+                coll.update_many({"$and": [free, {"_id": {"$in": ids}}]},
+                                 [{"$set": {"lease": {"owner": self.owner, 
+                                                      "expires": {"$add": ["$$NOW", self.lease_ttl*1000]}}}}])
+                claimed = [Article.from_doc(d) for d in coll.find({"_id": {"$in": ids}, "lease.owner": self.owner},
+                                                                  Article.fields, batch_size=size)]
+                if claimed:
+                    return claimed
+                # the candidates are leased by other workers now, so they are not read again
+                logger.debug ("All %s candidates claimed by other workers, retrying", len(ids))
+        
+        def heartbeat(self, stop, interval=None):
+            '''extends the leases held by this process until stopped,
+            so that documents waiting in the queue are not reclaimed by other workers.
+            
+            Args:
+                stop: a threading.Event set when the quotes stage is over
+                interval: a number of seconds between heartbeats, a third of the lease TTL if None
+            '''
+            
+            if interval is None:
+                interval = self.lease_ttl/3
+            while not stop.wait(interval):
+                try:
+                    self.db[self.collection].update_many({"lease.owner": self.owner},
+                            [{"$set": {"lease.expires": {"$add": ["$$NOW", self.lease_ttl*1000]}}}])
+                except Exception as e:
+                    logger.exception ("An error occurred at heartbeat: %s", e)
+        
+        def release(self, item):
+            '''releases the lease on a processed document.
+            
+            The document stays unclaimable for self.lease_retry seconds, 
+            so that articles whose quotes could not be found are not retried 
+            over and over by the workers of the same run.
+            
+            Args:
+                item: an Article record or a database document claimed by self.claim_batch
+            '''
+            
+            self.db[self.collection].update_one({"_id": item["_id"], "lease.owner": self.owner},
+                    [{"$set": {"lease": {"owner": None,
+                                         "expires": {"$add": ["$$NOW", self.lease_retry*1000]}}}}])
+        
+        def find_item(self, q,full, empty, maxsize=None, batch_size=None, checkpoint=None, resume=None):
+            '''claims batches of database documents without quotes
                and puts them into a limited size queue.
                
+               A resumed run first reclaims the documents in flight when 
+               the checkpoint was saved and then claims only the documents above its watermark.
+               
                Args:
-                    q: a queue-like list to append database documents
+                    q: a queue-like list to append Article records of database documents
                     full, empty: threading condition variables locking
                     producer and consumer threads while items are processed
                     and releasing when the queue is empty
                     maxsize: an integer defining max queue length
+                    batch_size: an integer number of documents leased at once
+                    checkpoint: an optional Checkpoint instance the claimed ids are reported to,
+                                flagged as failed if the documents could not be claimed
+                    resume: an optional checkpoint document of a crashed run to resume
             '''
             
             if maxsize is None:
                 maxsize=500
-            cursor = self.db[self.collection].find({self.field: {"$exists": False }})
-            for i in cursor:
+            if batch_size is None:
+                batch_size=50
+            try:
+                self.create_event_index()
+                match, redo = None, []
+                if resume:
+                    if resume.get("inflight"):
+                        redo = self.claim_batch(len(resume["inflight"]), {"_id": {"$in": resume["inflight"]}},
+                                                takeover=resume.get("owner"))
+                    if resume.get("watermark") is not None:
+                        match = {"_id": {"$gt": resume["watermark"]}}
+                # the reclaimed documents first, then batches until the backlog is exhausted
+                for batch in chain([redo], iter(partial(self.claim_batch, batch_size, match), [])):
+                    if checkpoint is not None:
+                        checkpoint.claimed([i["_id"] for i in batch])
+                    for i in batch:
+                        waited = False
+                        with full:
+                            while len(q)>=maxsize:
+                                waited = True
+                                empty.notifyAll()
+                                full.wait()
+                            q.append(i)
+                            metrics.queue_depth.set(len(q), stage='quotes')
+                            empty.notifyAll()
+                        # logged outside the lock to keep lock hold times short
+                        if waited:
+                            logger.debug ("Queue was full, size = %s", maxsize)
+                logger.info ('all items added')
+            except Exception as e:
+                logger.exception ("An error occurred at find_item: %s", e)
+                # the resume position is kept, as the backlog was not exhausted
+                if checkpoint is not None:
+                    checkpoint.fail()
+            finally:
+                # the consumers stop even if the producer failed
                 with full:
-                    while len(q)>=maxsize:
-                        print(f"Queue is full and size = {len(q)}")
-                        empty.notifyAll()
-                        full.wait()
-                    q.append(i)
+                    [q.append(None) for i in range(10)]
                     empty.notifyAll()
-            [q.append(None) for i in range(10)]
-            print ('all items added')
         
-        def updater(self, q, full, empty):
+        def process_item(self, item, inst, loop, stage='quotes'):
+            '''searches for ticker symbols in an article, requests
+            stock quotes around its publication date and dumps them 
+            to the database with an asyncio callback.
+            
+            Args:
+                item: an Article record or a database document
+                inst: an Alpaca class instance
+                loop: an event loop running the requests
+                stage: a string stage name the item is reported to metrics under
+            '''
+            
+            started = time.perf_counter()
+            date = item['time']
+            # a ticker mentioned twice is quoted once, label rows are keyed by the article and the ticker
+            tickers = list(dict.fromkeys(ticker_extraction(item ['article'])))
+            res =[]
+            for i in tickers:
+                task = asyncio.ensure_future(inst.make_request(date, ticker=i), loop=loop)
+                task.add_done_callback(partial (self.db_inserter, item=item))
+                res.append(task)
+            try:
+                fin = loop.run_until_complete(asyncio.gather(*res))
+            except ValueError as e:
+                # weekend publications, invalid tickers, etc.
+                logger.info ("No quotes at updater func: %s", e)
+            except Exception as e:
+                 logger.exception ("An error occurred at updater func: %s", e)  
+            finally:
+                metrics.doc_latency.observe(time.perf_counter()-started, stage=stage)
+                metrics.documents.inc(stage=stage)
+        
+        def updater(self, q, full, empty, checkpoint=None):
             '''loops through consumed news articles
-            and searches for ticker symbols in them.
+            and processes them with self.process_item.
             
-            instantiates Alpaca class and makes API requests 
-            for stock quotes around a given article publication date.
-            Then dumps them to database with an asyncio callback.
+            instantiates Alpaca class for making API requests.
+            Items are taken from the queue in FIFO order under the lock
+            and processed outside it, so that consumer threads run concurrently.
+            The lease on each item is released once it is processed.
             
             Args:
-                same as for self.find_item
+                same as for self.find_item, checkpoint is reported the processed ids
       
             '''
             #a new loop for each thread the task is distributed to
@@ -133,109 +318,358 @@ class MongoHandler:
             asyncio.set_event_loop(newloop)
             inst = alp.Alpaca ()
             while True:
+                waited = False
                 with empty:
                     while len(q) ==0:
-                         print(f"Queue is drained, recharging...{len(q)}")
+                         waited = True
                          full.notify()
                          empty.wait()
-                    item = q.pop() 
-                    if (item == None):
-                        self.loop_shutdown(newloop)
-                        break
-                    time = item['time']
-                    tickers = ticker_extraction(item ['article'])
-                    res =[]
-                    for i in tickers:
-                        task = asyncio.ensure_future(inst.make_request(time, ticker=i))
-                        task.add_done_callback(partial (self.db_inserter, item=item))
-                        res.append(task)
-                    try:
-                        fin = newloop.run_until_complete(asyncio.gather(*res))
-                    except Exception as e:
-                         logger.exception ("An error occurred at updater func: %s", e)  
-                    finally:
-                        asyncio.sleep(1)
-                        full.notify()
+                    item = q.pop(0) 
+                    metrics.queue_depth.set(len(q), stage='quotes')
+                    full.notify()
+                if waited:
+                    logger.debug ("Queue was drained, recharged")
+                if (item == None):
+                    self.loop_shutdown(newloop)
+                    break
+                try:
+                    self.process_item(item, inst, newloop)
+                finally:
+                    self.release(item)
+                    if checkpoint is not None:
+                        checkpoint.done(item["_id"])
                        
                     
+        def follow(self, poll_interval=None):
+            '''tails newly inserted articles and pushes each one
+            through ticker extraction, quote fetching and labelling as it arrives.
+            
+            A change stream is used where the deployment supports one (replica sets and sharded clusters).
+            Otherwise the collection is polled for documents with an "_id" greater than the last seen one.
+            Both the change stream resume token and the last seen "_id" are persisted
+            in the meta collection after each article, so a restarted follower
+            picks up where it stopped. A fresh follower starts from the newest article.
+            
+            Polling relies on ObjectIds growing with insertion time, 
+            which holds as long as articles are inserted by a single crawler host.
+            
+            Database errors, e.g. a lost connection or a failover, do not stop the follower:
+            it waits (1 second at first, doubling up to a minute) and resumes
+            from the persisted resume point.
+            
+            Args:
+                poll_interval: a number of seconds between polls, 
+                               FOLLOW_POLL_INTERVAL environment variable or 5 if None
+            '''
+            
+            if poll_interval is None:
+                poll_interval = float(os.getenv('FOLLOW_POLL_INTERVAL', 5))
+            newloop = asyncio.new_event_loop()
+            asyncio.set_event_loop(newloop)
+            inst = alp.Alpaca ()
+            coll = self.db[self.collection]
+            delay = 1
+            try:
+                while True:
+                    started = time.monotonic()
+                    try:
+                        self.follow_from(coll, inst, newloop, poll_interval)
+                    except pymongo.errors.PyMongoError as e:
+                        # network errors, failovers, etc. a follower is meant to outlive
+                        if time.monotonic() - started > 60:
+                            delay = 1
+                        logger.warning ('Follow mode interrupted (%s), resuming in %s seconds', e, delay)
+                        time.sleep(delay)
+                        delay = min(delay*2, 60)
+            except KeyboardInterrupt:
+                logger.info ('Follow mode stopped')
+            finally:
+                self.loop_shutdown(newloop)
+        
+        def follow_from(self, coll, inst, loop, poll_interval):
+            '''follows the collection from the persisted resume point until an error occurs.
+            
+            Args:
+                coll: a pymongo.collection instance with the articles
+                inst: an Alpaca class instance
+                loop: an event loop running the requests
+                poll_interval: a number of seconds between polls
+            '''
+            
+            self.create_event_index()
+            state = self.meta.find_one({"_id": "follow"}) or {}
+            if "last_id" not in state:
+                last = coll.find_one({}, {"_id": 1}, sort=[("_id", pymongo.DESCENDING)])
+                state["last_id"] = last["_id"] if last else None
+            try:
+                with coll.watch([{"$match": {"operationType": "insert"}},
+                                 # a nested "_id" is not kept by default, unlike the top-level one
+                                 {"$project": {"fullDocument._id": 1,
+                                               **{f"fullDocument.{f}": 1 for f in Article.fields}}}],
+                                resume_after=state.get("token")) as stream:
+                    logger.info ('Following the collection with a change stream')
+                    for change in stream:
+                        self.follow_item(Article.from_doc(change["fullDocument"]), inst, loop,
+                                         token=change["_id"])
+            except pymongo.errors.OperationFailure as e:
+                logger.info ('Change stream unavailable (%s), polling instead', e)
+                last_id = state["last_id"]
+                while True:
+                    query = {"_id": {"$gt": last_id}} if last_id else {}
+                    new = [Article.from_doc(d) for d in coll.find(query, Article.fields).sort("_id", 1).limit(100)]
+                    for doc in new:
+                        self.follow_item(doc, inst, loop)
+                        last_id = doc._id
+                    if not new:
+                        time.sleep(poll_interval)
+        
+        def follow_item(self, item, inst, loop, token=None):
+            '''processes a single new article in follow mode and records the resume point.
+            
+            The article is leased first, so that a concurrent quotes stage does not process it twice.
+            
+            Args:
+                item: an Article record of a newly inserted document
+                inst: an Alpaca class instance
+                loop: an event loop running the requests
+                token: a change stream resume token, if any
+            '''
+            
+            if self.claim_batch(1, {"_id": item["_id"]}):
+                try:
+                    self.process_item(item, inst, loop, stage='follow')
+                    self.merge_labels({"_id": item["_id"]})
+                except Exception as e:
+                    logger.exception ("An error occurred at follow_item: %s", e)
+                finally:
+                    self.release(item)
+            point = {"last_id": item["_id"]}
+            if token is not None:
+                point["token"] = token
+            self.meta.update_one({"_id": "follow"}, {"$set": point}, upsert=True)
+                
         def db_inserter(self, res, item):
             '''a callback function adding new field 
-               with stock quotes to the database.
+               with stock quotes to the database
+               and upserting the event row of the quoted ticker.
                
                Args: 
                    res: Alpaca.make_request coroutine wrapped into an asyncio task
-                   item: a database document to be updated
+                   item: an Article record or a database document to be updated
             '''
             
             try:
                 data = res.result()
                 if data== None:
-                    logger.info ("A None has arrived:(...")
+                    logger.debug ("A None has arrived:(...")
                 else:
-                    upd = self.db[self.collection].update_one({'article': item ['article']}, {'$push': 
-                                                                    {self.field: data}})
+                    with metrics.db_latency.time(stage='quotes'):
+                        upd = self.db[self.collection].update_one({'_id': item ['_id']}, {'$push': 
+                                                                        {self.field: data},
+                                                                        '$currentDate': {self.stamp: True}})
+                        row = event_row(item['_id'], item['time'], data, alp.Alpaca.returns, self.label_threshold)
+                        self.events.replace_one({'_id': row['_id']}, row, upsert=True)
+                    metrics.db_writes.inc(stage='quotes', op='update')
+                    metrics.db_writes.inc(stage='quotes', op='upsert')
                   #  logger.info (upd.modified_count)
+            except ValueError as e:
+                logger.info ("No quotes at db_inserter: %s", e)
             except  Exception as e:
                 logger.exception ("An error occurred at db_inserter: %s", e)  
                     
         def loop_shutdown(self, loop):
             '''graceful shutdown of asyncio pending tasks.
             
+            Only the tasks of the given loop are cancelled, other threads' loops keep running.
+            Cancelled requests are logged, their documents are picked up again 
+            once their leases expire or by a resumed run.
+            
             Args:
-                loop: a running event loop to be stopped
+                loop: an event loop owned by the calling thread, closed afterwards
             '''
             
-            pending= [t for t in asyncio.Task.all_tasks()]
+            pending= [t for t in asyncio.all_tasks(loop) if not t.done()]
+            if pending:
+                logger.warning ("%s pending requests cancelled at shutdown", len(pending))
             for p in pending:
                 p.cancel()  
             try:
-                loop.run_until_complete(asyncio.gather(*pending))
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
             except Exception as e:
                 logger.exception ("An error occurred at shutdown: %s", e) 
-            loop.stop()
+            loop.close()
+            
+        
+        def migrate_windows(self, batch_size=500):
+            '''rewrites event windows stored in the legacy list-of-dicts format
+            to the compact format of parallel timestamp and close arrays.
+            
+            Documents are updated in unordered bulk batches. Each update 
+            is conditioned on the quotes field being unchanged since it was read,
+            so that quotes pushed concurrently are not overwritten.
+            
+            Args:
+                batch_size: an integer number of documents per cursor batch and bulk write
+            '''
+            
+            legacy = {f"{self.field}.event_window.0": {"$exists": True}}
+            cursor = self.db[self.collection].find(legacy, {self.field: 1}, batch_size=batch_size)
+            ops, migrated = [], 0
+            for doc in cursor:
+                quotes = [compact_window(q) if q else q for q in doc[self.field]]
+                ops.append(pymongo.UpdateOne({"_id": doc["_id"], self.field: doc[self.field]},
+                                             {"$set": {self.field: quotes}}))
+                if len(ops) >= batch_size:
+                    migrated += self.db[self.collection].bulk_write(ops, ordered=False).modified_count
+                    ops = []
+            if ops:
+                migrated += self.db[self.collection].bulk_write(ops, ordered=False).modified_count
+            logger.info ('%s documents migrated to compact event windows', migrated)
+        
+        def create_event_index(self):
+            '''makes sure the events collection is indexed for per-ticker time range queries'''
+            self.events.create_index([("ticker", pymongo.ASCENDING), ("time", pymongo.ASCENDING)])
+        
+        def backfill_events(self, match=None, threshold=None):
+            '''rebuilds the event rows of the quoted articles with the label stages
+            and upserts them into the events collection with "$merge".
+            
+            Rows are keyed by the article id and the ticker, the same as db_inserter writes them,
+            so the backfill can run alongside the quotes stage and be repeated at will,
+            e.g. to relabel the events with another threshold.
+            
+            Args:
+                match: an optional query selecting the articles, all of them if None
+                threshold: a float label threshold, self.label_threshold if None
+            '''
+            
+            threshold = self.label_threshold if threshold is None else threshold
+            self.create_event_index()
+            quote = "$"+self.field
+            stages = ([{"$match": match}] if match else []) + self.label_stages(threshold) + [
+                       {"$project": {"_id": {"article": "$_id", "ticker": quote+".ticker"},
+                                     "ticker": quote+".ticker",
+                                     "time": 1,
+                                     "alpha": quote+".alpha",
+                                     "beta": quote+".beta",
+                                     "car": quote+"."+alp.Alpaca.returns,
+                                     "label": 1}},
+                       {"$merge": {"into": self.events.name, "on": "_id",
+                                   "whenMatched": "replace", "whenNotMatched": "insert"}}
+                      ]
+            self.db[self.collection].aggregate(stages)
+            logger.info ('Events collection %s is up to date', self.events.name)
+        
+        def label_stages(self, threshold):
+            '''builds aggregation stages unwinding the quotes field
+            and adding a label to each (article, ticker) pair.
+            
+            Args:
+                threshold: a float absolute value of abnormal returns (in per cents)
+                separating '1' labels from '0' ones
+            
+            Returns:
+                a list of aggregation pipeline stages
+            '''
+            
+            var = f"{self.field}"
+            subvar = "$"+var+"."+alp.Alpaca.returns
+            return [
+                   {"$unwind": "$"+var},
+                   {"$match" : {
+                       var: {
+                            "$exists": True,
+                            "$ne": None}
+                   }}, 
+                   {"$addFields":{
+                       "label":{
+                            "$switch":{
+                                "branches":[
+                                    {"case": {"$or":[{"$lt":[subvar, -threshold]},
+                                                      {"$gt":[subvar, threshold]}]},
+                                     "then":"1"},
+            
+                                    {"case": { "$and":[{"$lt":[subvar,threshold]}, 
+                                                       {"$gt": [subvar,-threshold]}]},
+                                     "then":"0"}
+                                ],
+                                 "default": "None"
+                            }
+                        }
+                   }},
+            ]
+        
+        def label_key(self):
+            '''returns an aggregation stage keying label rows by the article id and the ticker,
+            so that full rebuilds and incremental upserts write the same "_id" values.
+            
+            Each row is also stamped with the server time it was written at ("labelled"),
+            which the dataset exporter resumes from.
+            '''
+            
+            return {"$set": {"_id": {"article": "$_id", 
+                                     "ticker": "$"+self.field+".ticker"},
+                             "labelled": "$$NOW"}}
+        
+        def merge_labels(self, match, target=None, threshold=None):
+            '''labels the articles matching a query and upserts the results 
+            into the output collection with "$merge", 
+            keyed by the article id and the ticker.
+            
+            Args:
+                match: a query selecting the articles to be labelled
+                target, threshold: same as for self.labelling
+            '''
             
+            target = target or self.label_target
+            threshold = self.label_threshold if threshold is None else threshold
+            stages = [{"$match": match}] + self.label_stages(threshold) + [
+                       self.label_key(),
+                       {"$merge": {"into": target, "on": "_id",
+                                   "whenMatched": "replace", "whenNotMatched": "insert"}}
+                      ]
+            self.db[self.collection].aggregate(stages)
         
-        def labelling(self):
+        def labelling(self, incremental=False, target=None, threshold=None):
             '''labels database articles with '1' if the stock mentioned in a given article
-            gained abnornal returns greater then 2 per cents in absolute terms 
-            right after the publication or '0' otherwise.
+            gained abnornal returns greater then the threshold (2 per cents by default)
+            in absolute terms right after the publication or '0' otherwise.
             
             If more than one stock is mentioned in the article,
             an output document for each stock is created using "$unwind" mongo command.
             
             Outputs the results to another collection to avoid confusion.
+            By default the output collection is rebuilt from scratch with "$out".
+            Rows are keyed by the article id and the ticker in both modes.
+            In incremental mode only the articles whose quotes were updated
+            since the previous run are labelled and upserted into the output
+            collection with "$merge", keyed by the article id and the ticker.
+            
+            Args:
+                incremental: a boolean switching "$out" rebuild to "$merge" upserts
+                target: a string name of the output collection, 
+                        self.label_target if None
+                threshold: a float label threshold, self.label_threshold if None
             '''
             
-            var = f"{self.field}"
-            subvar = var+"."+alp.Alpaca.returns
-            labels =self.db[self.collection].aggregate([
-                           {"$unwind": "$"+var},
-                           {"$match" : {
-                               var: {
-                                    "$exists": True },
-                               var: {
-                                    "$ne": None}
-                           }}, 
-                           {"$addFields":{
-                               "label":{
-                                    "$switch":{
-                                        "branches":[
-                                            {"case": {"$or":[{"$lt":[subvar, -2]},
-                                                              {"$gt":[subvar, 2]}]},
-                                             "then":"1"},
-                    
-                                            {"case": { "$and":[{"$lt":[subvar,2]}, 
-                                                               {"$gt": [subvar,-2]}]},
-                                             "then":"0"}
-                                        ],
-                                         "default": "None"
-                                    }
-                                }
-                           }},
-                           {"$project":{"_id":0}},
-                           {"$out": "another_collection"}
-                    ])  
+            target = target or self.label_target
+            threshold = self.label_threshold if threshold is None else threshold
+            key = f"labelling:{target}"
+            # the server clock is used both here and in db_inserter, 
+            # so that hosts with skewed clocks do not lose updates
+            run = self.meta.find_one_and_update({"_id": key}, 
+                                                {"$currentDate": {"started": True}},
+                                                upsert=True,
+                                                return_document=pymongo.ReturnDocument.AFTER)
+            if incremental:
+                self.db[self.collection].create_index(self.stamp, sparse=True)
+                since = run.get("last_run")
+                self.merge_labels({self.stamp: {"$gte": since}} if since else {}, target, threshold)
+            else:
+                stages = self.label_stages(threshold) + [
+                           self.label_key(),
+                           {"$out": target}
+                          ]
+                self.db[self.collection].aggregate(stages)
+            self.meta.update_one({"_id": key}, {"$set": {"last_run": run["started"]}})
             logger.info ('Data is labelled now!')
-
-
-
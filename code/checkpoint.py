@@ -0,0 +1,97 @@
+'''periodic checkpoints of long runs, so that a crashed run can be resumed.
+
+A stage reading a collection in "_id" order reports the ids it takes up (claimed)
+and the ids it is done with (done). The checkpoint, saved to the meta collection
+every CHECKPOINT_INTERVAL seconds (30 by default), holds the highest id taken up,
+the watermark, and the ids taken up but not done yet, the in-flight ids.
+A resumed run redoes the in-flight ids and carries on above the watermark.
+A run that failed is flagged, so that its checkpoint is kept when it ends.
+'''
+
+import os
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger("debugger")
+
+
+class Checkpoint:
+    '''the resume position of a stage, persisted in the meta collection.
+
+       Attributes:
+           meta: a pymongo.collection instance the checkpoint is saved to
+           key: a string "_id" of the checkpoint document
+           interval: a number of seconds between saves
+           watermark: the highest id taken up so far, None if none
+           inflight: a set of ids taken up but not done yet
+           extra: a dict of additional values saved with the checkpoint
+           failed: a boolean set if the stage failed, the checkpoint is kept for --resume then
+    '''
+
+    def __init__(self, meta, name, interval=None, **extra):
+        '''Inits Checkpoint
+
+           Args:
+               meta: a pymongo.collection instance the checkpoint is saved to
+               name: a string stage name, suffixed with a worker id if the stage runs on several workers
+               interval: a number of seconds between saves, CHECKPOINT_INTERVAL environment variable or 30 if None
+               extra: additional values saved with the checkpoint
+        '''
+        self.meta = meta
+        self.key = f"checkpoint:{name}"
+        self.interval = interval if interval is not None else float(os.getenv('CHECKPOINT_INTERVAL', 30))
+        self.watermark = None
+        self.inflight = set()
+        self.extra = extra
+        self.failed = False
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''returns the saved checkpoint document, None if there is none'''
+        saved = self.meta.find_one({"_id": self.key})
+        if saved:
+            logger.info("Resuming after %s with %s items in flight, checkpoint of %s",
+                        saved.get("watermark"), len(saved.get("inflight", [])), saved.get("updated"))
+        return saved
+
+    def claimed(self, ids):
+        '''records ids taken up, in ascending order'''
+        with self.lock:
+            for i in ids:
+                self.inflight.add(i)
+                if self.watermark is None or i > self.watermark:
+                    self.watermark = i
+
+    def done(self, _id):
+        '''records an id as done'''
+        with self.lock:
+            self.inflight.discard(_id)
+
+    def fail(self):
+        '''records that the stage did not complete'''
+        self.failed = True
+
+    def save(self):
+        '''writes the current resume position'''
+        with self.lock:
+            doc = {"watermark": self.watermark, "inflight": sorted(self.inflight),
+                   "updated": datetime.utcnow(), **self.extra}
+        self.meta.replace_one({"_id": self.key}, doc, upsert=True)
+
+    def run(self, stop):
+        '''saves the checkpoint every self.interval seconds until stopped, then once more.
+
+           Args:
+               stop: a threading.Event set when the stage is over
+        '''
+        while not stop.wait(self.interval):
+            try:
+                self.save()
+            except Exception as e:
+                logger.exception("An error occurred at checkpoint: %s", e)
+        self.save()
+
+    def clear(self):
+        '''deletes the checkpoint of a completed run'''
+        self.meta.delete_one({"_id": self.key})
@@ -0,0 +1,167 @@
+'''a shared MongoDB connection layer.
+
+Every module gets its MongoClient from get_client, so a process keeps one
+connection pool per URI, configured from environment variables:
+
+    * MONGO_MAX_POOL_SIZE, MONGO_MIN_POOL_SIZE - connections per server
+    * MONGO_MAX_IDLE_TIME_MS, MONGO_WAIT_QUEUE_TIMEOUT_MS - pool connection lifetime and checkout wait
+    * MONGO_CONNECT_TIMEOUT_MS, MONGO_SOCKET_TIMEOUT_MS, MONGO_SERVER_SELECTION_TIMEOUT_MS - timeouts
+    * MONGO_COMPRESSORS - a comma-separated list of wire compressors, unless the URI sets compressors,
+      zstd, snappy and zlib by default, those whose Python modules are installed
+    * MONGO_ZLIB_LEVEL - zlib compression level (-1 to 9)
+    * MONGO_READ_CONCERN, MONGO_READ_PREFERENCE - e.g. "majority", "secondaryPreferred"
+    * MONGO_WRITE_CONCERN, MONGO_JOURNAL - e.g. "majority" or "1", "true"
+
+Options given in the URI itself are overridden by the environment variables set.
+Pool utilisation is reported to the metrics registry (mongo_pool_* metrics)
+and returned by pool_stats.
+'''
+
+import os
+import threading
+import logging
+import importlib.util
+from urllib.parse import parse_qs, urlsplit
+import pymongo
+from pymongo import monitoring
+from data_digger import metrics
+
+logger = logging.getLogger("debugger")
+
+# environment variables mapped to MongoClient keyword arguments and value types
+OPTIONS = {
+    'MONGO_MAX_POOL_SIZE': ('maxPoolSize', int),
+    'MONGO_MIN_POOL_SIZE': ('minPoolSize', int),
+    'MONGO_MAX_IDLE_TIME_MS': ('maxIdleTimeMS', int),
+    'MONGO_WAIT_QUEUE_TIMEOUT_MS': ('waitQueueTimeoutMS', int),
+    'MONGO_CONNECT_TIMEOUT_MS': ('connectTimeoutMS', int),
+    'MONGO_SOCKET_TIMEOUT_MS': ('socketTimeoutMS', int),
+    'MONGO_SERVER_SELECTION_TIMEOUT_MS': ('serverSelectionTimeoutMS', int),
+    'MONGO_COMPRESSORS': ('compressors', str),
+    'MONGO_ZLIB_LEVEL': ('zlibCompressionLevel', int),
+    'MONGO_READ_CONCERN': ('readConcernLevel', str),
+    'MONGO_READ_PREFERENCE': ('readPreference', str),
+    'MONGO_WRITE_CONCERN': ('w', lambda v: int(v) if v.isdigit() else v),
+    'MONGO_JOURNAL': ('journal', lambda v: v.lower() in ('1', 'true', 'yes')),
+}
+
+# wire compressors in order of preference and the modules they need
+COMPRESSORS = (('zstd', 'zstandard'), ('snappy', 'snappy'), ('zlib', 'zlib'))
+
+_clients = {}
+_lock = threading.Lock()
+
+
+class PoolStats(monitoring.ConnectionPoolListener):
+    '''a connection pool listener keeping per-server counts of
+       open and checked out connections and checkout wait times.
+    '''
+
+    def __init__(self):
+        '''Inits PoolStats'''
+        self.lock = threading.Lock()
+        self.servers = {}
+
+    def _update(self, event, key, n):
+        server = '%s:%s' % event.address
+        with self.lock:
+            stats = self.servers.setdefault(server, {'open': 0, 'checked_out': 0})
+            stats[key] += n
+            value = stats[key]
+        gauge = metrics.pool_connections if key == 'open' else metrics.pool_checked_out
+        gauge.set(value, server=server)
+
+    def connection_created(self, event):
+        self._update(event, 'open', 1)
+
+    def connection_closed(self, event):
+        self._update(event, 'open', -1)
+
+    def connection_checked_out(self, event):
+        self._update(event, 'checked_out', 1)
+        # reported by pymongo 4.7+
+        if getattr(event, 'duration', None) is not None:
+            metrics.pool_wait.observe(event.duration)
+
+    def connection_checked_in(self, event):
+        self._update(event, 'checked_out', -1)
+
+    def connection_check_out_failed(self, event):
+        metrics.pool_failures.inc(reason=str(event.reason))
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_check_out_started(self, event):
+        pass
+
+
+pool = PoolStats()
+
+
+def client_options(uri=None):
+    '''returns a dict of MongoClient keyword arguments read from environment variables.
+
+       Args:
+           uri: a Mongo URI string, the default compressors are left out if it sets any
+
+       Returns:
+           a dict of keyword arguments
+    '''
+    options = {}
+    for var, (name, convert) in OPTIONS.items():
+        value = os.getenv(var)
+        if value:
+            options[name] = convert(value)
+    query = urlsplit(uri).query if uri else ''
+    if 'compressors' not in {k.lower() for k in parse_qs(query)}:
+        options.setdefault('compressors', ','.join(
+            name for name, module in COMPRESSORS if importlib.util.find_spec(module) is not None))
+    return options
+
+
+def get_client(uri=None):
+    '''returns the process-wide MongoClient of a URI, creating it on the first call.
+
+       Args:
+           uri: a Mongo URI string, MONGO_URI environment variable if None
+
+       Returns:
+           a pymongo.MongoClient instance, which callers share and must not close
+    '''
+
+    uri = uri or os.getenv('MONGO_URI')
+    with _lock:
+        if uri not in _clients:
+            options = client_options(uri)
+            logger.debug("Connecting to Mongo DB with %s", options)
+            _clients[uri] = pymongo.MongoClient(uri, event_listeners=[pool], **options)
+        return _clients[uri]
+
+
+def close_all():
+    '''closes every shared client'''
+    with _lock:
+        for client in _clients.values():
+            client.close()
+        _clients.clear()
+
+
+def pool_stats():
+    '''returns a dict mapping "host:port" strings to dicts
+       of open and checked out connection counts
+    '''
+    with pool.lock:
+        return {server: dict(stats) for server, stats in pool.servers.items()}
@@ -0,0 +1,270 @@
+'''this module exports labelled articles to an on-disk training dataset:
+
+    * hashed_features - turns a text into hashed sparse word-count features
+    * DatasetExporter - streams labelled documents from Mongo DB in chunks
+      and appends them to flat binary arrays, resuming where the previous export stopped
+    * load_dataset - memory-maps an exported dataset
+
+Features are stored in CSR layout (indptr, indices, data), so a training job can build
+scipy.sparse.csr_matrix((data, indices, indptr), shape=(rows, n_features))
+without copying the arrays into memory.
+'''
+
+import json
+import os
+import re
+import zlib
+import logging
+from datetime import timedelta, timezone
+import numpy as np
+from bson import json_util
+
+logger = logging.getLogger("debugger")
+
+# file name and dtype of each array
+ARRAYS = {
+    'indptr': np.int64,
+    'indices': np.int32,
+    'data': np.float32,
+    'labels': np.int8,
+    'car': np.float64,
+    'time': np.int64,
+    'ticker': 'S12',
+    # raw ObjectId bytes, 'S12' would strip trailing NUL bytes
+    'article_id': 'V12',
+    # 1 for a row replaced by a later export of the same label row
+    'superseded': np.uint8,
+}
+
+
+def array_sizes(rows, nnz):
+    '''returns a dict of array lengths of a dataset with given numbers of rows and non-zero values,
+       indptr has one more entry than rows
+    '''
+    return {'indptr': rows + 1, 'indices': nnz, 'data': nnz, 'labels': rows,
+            'car': rows, 'time': rows, 'ticker': rows, 'article_id': rows, 'superseded': rows}
+
+
+def hashed_features(text, n_features):
+    '''hashes lowercase words of a text into n_features columns.
+       The sign of each count is taken from the hash, so that collisions cancel out on average.
+
+       Args:
+           text: a string variable
+           n_features: an integer number of feature columns
+
+       Returns:
+           a tuple of a sorted int32 array of column indices and a float32 array of values
+    '''
+
+    h = np.fromiter((zlib.crc32(w.encode()) for w in re.findall(r"[a-z0-9']+", text.lower())),
+                    dtype=np.uint32)
+    sign = np.where(h >> 31, -1.0, 1.0).astype(np.float32)
+    cols, inverse = np.unique((h % n_features).astype(np.int32), return_inverse=True)
+    values = np.zeros(len(cols), dtype=np.float32)
+    np.add.at(values, inverse, sign)
+    keep = values != 0
+    return cols[keep], values[keep]
+
+
+class DatasetExporter:
+    '''streams labelled documents into a dataset directory.
+
+       The directory holds one raw binary file per array plus manifest.json
+       recording the number of rows and non-zero values written and the watermark,
+       the write time ("labelled") and the "_id" of the last exported row.
+       The manifest is replaced only after a chunk is flushed to disk, and files are truncated
+       back to the manifest sizes before an export, so an interrupted export resumes cleanly.
+
+       Each label row (an article and a ticker) is kept once: a row exported again
+       with the same label and CAR is skipped, and one with a new label or CAR is appended
+       while the older row is flagged in the superseded array.
+
+       Attributes:
+           path: a string path of the dataset directory
+           n_features: an integer number of hashed feature columns
+           chunk_size: an integer number of documents converted and appended at once
+           settle: a number of seconds label rows are left to settle before they are exported
+           manifest: a dict of dataset state
+    '''
+
+    def __init__(self, path, n_features=2**20, chunk_size=1000, settle=None):
+        '''Inits DatasetExporter, loading the manifest of an existing dataset'''
+        self.path = path
+        self.chunk_size = chunk_size
+        self.settle = settle if settle is not None else float(os.getenv('EXPORT_SETTLE', 60))
+        os.makedirs(path, exist_ok=True)
+        manifest = os.path.join(path, 'manifest.json')
+        if os.path.exists(manifest):
+            with open(manifest) as f:
+                self.manifest = json.load(f)
+            if self.manifest['n_features'] != n_features:
+                logger.info("Dataset has %s features, keeping them", self.manifest['n_features'])
+        else:
+            self.manifest = {'n_features': n_features, 'rows': 0, 'nnz': 0,
+                             'last_labelled': None, 'last_id': None}
+        self.n_features = self.manifest['n_features']
+
+    def _truncate(self):
+        '''drops whatever an interrupted export appended after the last manifest'''
+        for name, count in array_sizes(self.manifest['rows'], self.manifest['nnz']).items():
+            fname = os.path.join(self.path, name)
+            size = count * np.dtype(ARRAYS[name]).itemsize
+            with open(fname, 'ab') as f:
+                f.truncate(size)
+        if self.manifest['rows'] == 0:
+            with open(os.path.join(self.path, 'indptr'), 'wb') as f:
+                np.zeros(1, dtype=np.int64).tofile(f)
+
+    def _index(self):
+        '''maps (article id, ticker) keys of the rows exported so far, superseded ones aside,
+           to tuples of the row number, the label and CAR
+        '''
+        rows = self.manifest['rows']
+        if rows == 0:
+            return {}
+        a = {name: np.fromfile(os.path.join(self.path, name), dtype=ARRAYS[name], count=rows)
+             for name in ('article_id', 'ticker', 'labels', 'car', 'superseded')}
+        return {(a['article_id'][i].tobytes(), bytes(a['ticker'][i])): (i, int(a['labels'][i]), float(a['car'][i]))
+                for i in np.flatnonzero(a['superseded'] == 0).tolist()}
+
+    def _append(self, chunk):
+        nnz = self.manifest['nnz']
+        cols, vals, lengths = [], [], []
+        for doc in chunk['text']:
+            c, v = hashed_features(doc, self.n_features)
+            cols.append(c)
+            vals.append(v)
+            lengths.append(len(c))
+        arrays = {
+            'indptr': nnz + np.cumsum(lengths, dtype=np.int64),
+            'indices': np.concatenate(cols) if cols else np.zeros(0, np.int32),
+            'data': np.concatenate(vals) if vals else np.zeros(0, np.float32),
+        }
+        for name in ('labels', 'car', 'time', 'ticker', 'article_id'):
+            arrays[name] = np.asarray(chunk[name], dtype=ARRAYS[name])
+        arrays['superseded'] = np.zeros(len(lengths), dtype=np.uint8)
+        for name, arr in arrays.items():
+            with open(os.path.join(self.path, name), 'ab') as f:
+                arr.astype(ARRAYS[name], copy=False).tofile(f)
+                f.flush()
+                os.fsync(f.fileno())
+        # flagged after the new rows are on disk, an interrupted export redoes both
+        if chunk['superseded']:
+            with open(os.path.join(self.path, 'superseded'), 'r+b') as f:
+                for row in chunk['superseded']:
+                    f.seek(row)
+                    f.write(b'\x01')
+                f.flush()
+                os.fsync(f.fileno())
+        self.manifest['rows'] += len(lengths)
+        self.manifest['nnz'] += int(sum(lengths))
+        self.manifest['last_labelled'] = chunk['last_labelled']
+        self.manifest['last_id'] = chunk['last_id']
+        tmp = os.path.join(self.path, 'manifest.json.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(tmp, os.path.join(self.path, 'manifest.json'))
+
+    def export(self, collection, field, returns):
+        '''appends labelled documents not exported yet, in the order they were labelled.
+
+           Rows labelled "None" are skipped. Progress is tracked by the server time
+           each row was written at ("labelled", see MongoHandler.label_key), then by "_id",
+           so rows labelled after the previous export are picked up even for older articles.
+           A relabelled row is appended only if its label or CAR changed, superseding the older one. Rows written less than self.settle seconds
+           before the export started are left for the next one, so that a labelling run
+           still in progress is not cut in the middle of a timestamp.
+           A "$out" rebuild restamps every row, so export it to a fresh directory.
+
+           Args:
+               collection: a pymongo.collection instance with the label rows
+               field: a string name of the quotes field
+               returns: a string name of the abnormal returns key of the quotes field
+
+           Returns:
+               an integer number of rows appended
+        '''
+
+        self._truncate()
+        collection.create_index([('labelled', 1), ('_id', 1)])
+        # the server clock, the same one the rows are stamped with
+        now = collection.database.command('isMaster')['localTime']
+        query = {'label': {'$in': ['0', '1']},
+                 'labelled': {'$lt': now - timedelta(seconds=self.settle)}}
+        last_labelled, last_id = self.manifest.get('last_labelled'), self.manifest['last_id']
+        if last_labelled is not None:
+            last_labelled, last_id = json_util.loads(last_labelled), json_util.loads(last_id)
+            query['$or'] = [{'labelled': {'$gt': last_labelled}},
+                            {'labelled': last_labelled, '_id': {'$gt': last_id}}]
+        else:
+            # rows labelled before they were stamped sort first, in "_id" order
+            unstamped = {'label': query['label'], 'labelled': {'$exists': False}}
+            if last_id is not None:
+                unstamped['_id'] = {'$gt': json_util.loads(last_id)}
+            query = {'$or': [query, unstamped]}
+        projection = {'article': 1, 'time': 1, 'label': 1, 'labelled': 1,
+                      f'{field}.ticker': 1, f'{field}.{returns}': 1}
+        cursor = collection.find(query, projection, batch_size=self.chunk_size).sort([('labelled', 1), ('_id', 1)])
+        index = self._index()
+        appended = 0
+        chunk = _empty_chunk()
+        for doc in cursor:
+            quote = doc.get(field) or {}
+            article_id = doc['_id']['article'] if isinstance(doc['_id'], dict) else doc['_id']
+            key = (getattr(article_id, 'binary', bytes(12)), quote.get('ticker', '').encode())
+            label, car = int(doc['label']), float(quote.get(returns, np.nan))
+            chunk['last_labelled'] = json_util.dumps(doc['labelled']) if 'labelled' in doc else None
+            chunk['last_id'] = json_util.dumps(doc['_id'])
+            old = index.get(key)
+            if old is not None:
+                if old[1] == label and (old[2] == car or np.isnan(old[2]) and np.isnan(car)):
+                    continue
+                chunk['superseded'].append(old[0])
+            index[key] = (self.manifest['rows'] + len(chunk['text']), label, car)
+            chunk['text'].append(doc.get('article', ''))
+            chunk['labels'].append(label)
+            chunk['car'].append(car)
+            # pymongo returns naive datetimes in UTC
+            chunk['time'].append(int(doc['time'].replace(tzinfo=timezone.utc).timestamp()) if doc.get('time') else 0)
+            chunk['ticker'].append(key[1])
+            chunk['article_id'].append(key[0])
+            if len(chunk['text']) >= self.chunk_size:
+                self._append(chunk)
+                appended += len(chunk['text'])
+                chunk = _empty_chunk()
+        # a chunk of skipped rows only moves the watermark
+        if chunk['last_id'] is not None:
+            self._append(chunk)
+            appended += len(chunk['text'])
+        logger.info("%s rows exported to %s, %s in total", appended, self.path, self.manifest['rows'])
+        return appended
+
+
+def _empty_chunk():
+    return {'text': [], 'labels': [], 'car': [], 'time': [], 'ticker': [], 'article_id': [],
+            'superseded': [], 'last_labelled': None, 'last_id': None}
+
+
+def load_dataset(path):
+    '''memory-maps an exported dataset.
+
+       Args:
+           path: a string path of the dataset directory
+
+       Returns:
+           a dict mapping array names to read-only numpy memmaps,
+           plus 'rows' and 'n_features' integers.
+           Rows flagged in 'superseded' have a later row of the same article and ticker
+           and should be masked out of training.
+    '''
+
+    with open(os.path.join(path, 'manifest.json')) as f:
+        manifest = json.load(f)
+    out = {'rows': manifest['rows'], 'n_features': manifest['n_features']}
+    for name, count in array_sizes(manifest['rows'], manifest['nnz']).items():
+        if count == 0:
+            out[name] = np.zeros(0, dtype=ARRAYS[name])
+        else:
+            out[name] = np.memmap(os.path.join(path, name), dtype=ARRAYS[name], mode='r', shape=(count,))
+    return out
@@ -0,0 +1,86 @@
+'''central logging setup of the package.
+
+Records are put on a queue by the calling thread and written to the console
+by a single listener thread, so worker threads never block on console I/O.
+Repetitive messages are rate-limited per message template before they are queued.
+
+The level is read from LOG_LEVEL environment variable (INFO by default).
+'''
+
+import atexit
+import logging
+import os
+import queue
+import sys
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+FORMAT = "%(asctime)s %(levelname)s:%(name)s: %(message)s"
+_listener = None
+
+
+class RateLimitFilter(logging.Filter):
+    '''lets through at most `burst` records of the same template per `period` seconds.
+
+    Records are grouped by logger name, level and unformatted message,
+    so "invalid ticker %s" is limited as a whole whatever the ticker is.
+    The first record let through after a suppression reports how many were dropped.
+
+    Attributes:
+        burst: an integer number of records allowed per period
+        period: a float number of seconds
+    '''
+
+    def __init__(self, burst=10, period=60.0):
+        '''Inits RateLimitFilter'''
+        super().__init__()
+        self.burst = burst
+        self.period = period
+        self.state = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.ERROR:
+            return True
+        key = (record.name, record.levelno, str(record.msg))
+        now = time.monotonic()
+        with self.lock:
+            tokens, last, suppressed = self.state.get(key, (self.burst, now, 0))
+            tokens = min(self.burst, tokens + (now - last) * self.burst / self.period)
+            if tokens < 1:
+                self.state[key] = (tokens, now, suppressed + 1)
+                return False
+            self.state[key] = (tokens - 1, now, 0)
+        if suppressed:
+            record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+        return True
+
+
+def configure(level=None, burst=None, period=None):
+    '''installs the queue-backed root handler, once per process.
+
+    Args:
+        level: a logging level name or number, LOG_LEVEL environment variable or INFO if None
+        burst, period: rate limit of repetitive messages, LOG_BURST and LOG_PERIOD
+                       environment variables or 10 messages per 60 seconds if None
+    '''
+
+    global _listener
+    if _listener is not None:
+        return
+    level = level or os.getenv('LOG_LEVEL', 'INFO')
+    burst = burst or int(os.getenv('LOG_BURST', 10))
+    period = period or float(os.getenv('LOG_PERIOD', 60))
+
+    console = logging.StreamHandler(sys.stderr)
+    console.setFormatter(logging.Formatter(FORMAT, datefmt="%H:%M:%S"))
+    records = queue.SimpleQueue()
+    handler = QueueHandler(records)
+    handler.addFilter(RateLimitFilter(burst, period))
+    root = logging.getLogger()
+    root.addHandler(handler)
+    root.setLevel(level)
+    _listener = QueueListener(records, console, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
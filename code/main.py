@@ -5,15 +5,26 @@ Tasks solved with iteration through a database collection
 are allocated among multiple threads.
 '''
 
+import os
 import sys
 import argparse
+import socket
 import time
+import logging
+from data_digger import log_config
 from data_digger import Mongo_module
+from data_digger import metrics
+
+log_config.configure()
+logger = logging.getLogger("debugger")
 
 
 parser = argparse.ArgumentParser()
 parser.add_argument ("--articles", help = "scrapes recent stock news articles from https://seekingalpha.com/",
                       action="store_true")
+parser.add_argument("--stream", help = ("used with --articles: filters, quotes and labels each scraped article "
+                                        "in memory and writes it to the database once"),
+                    action="store_true")
 parser.add_argument("--quotes", help = "gets stock quotes from Alpaca API and inserts them into the database",
                     action="store_true")
 parser.add_argument("--sweeper", help= "deletes articles with sentences of minimal length bearing no useful information."
@@ -21,66 +32,266 @@ parser.add_argument("--sweeper", help= "deletes articles with sentences of minim
                                         "Articles in which each sentence belongs to the leftmost (minimal) bin"
                                         "are deleted",
                    action="store_true")
+parser.add_argument("--resume", help = ("used with --quotes or --sweeper: resumes a run that crashed, "
+                                        "redoing the articles in flight at its last checkpoint and "
+                                        "skipping the ones below its resume position"),
+                    action = "store_true")
+parser.add_argument("--worker-id", default = os.getenv('WORKER_ID') or socket.gethostname(),
+                    help = ("used with --quotes: name of this worker's checkpoint, so that workers sharing the backlog "
+                            "resume their own runs. WORKER_ID environment variable or the host name by default, "
+                            "set it when several workers run on one host"))
 parser.add_argument("--label", help = ("labels the documents in the database with '1' "
                                        "if absolute value of abnormal returns is greater than 2%% or '0' otherwise"),
                    action = "store_true")
+parser.add_argument("--incremental", help = ("used with --label: labels only the documents whose quotes changed "
+                                             "since the previous run and upserts them into the target collection"),
+                   action = "store_true")
+parser.add_argument("--target", help = "used with --label: a collection to write the labels to "
+                                       "(LABEL_COLLECTION environment variable by default)")
+parser.add_argument("--threshold", type = float, 
+                    help = "used with --label or --events: abnormal returns threshold in per cents "
+                           "(LABEL_THRESHOLD environment variable or 2 by default)")
+parser.add_argument("--events", help = ("rebuilds the per-ticker events collection (one row per article and ticker "
+                                        "with time, alpha, beta, CAR and label, indexed by ticker and time) from the quotes "
+                                        "of all articles. The quotes stages keep it up to date afterwards"),
+                    action = "store_true")
+parser.add_argument("--follow", help = ("runs continuously: each newly inserted article is pushed through "
+                                        "ticker extraction, quote fetching and labelling as it arrives"),
+                   action = "store_true")
+parser.add_argument("--poll-interval", type = float,
+                    help = ("used with --follow: seconds between polls when change streams are unavailable "
+                            "(FOLLOW_POLL_INTERVAL environment variable or 5 by default)"))
+parser.add_argument("--export", metavar = "DIR",
+                    help = ("appends labelled documents not exported yet to a training dataset directory: "
+                            "hashed word features in CSR layout, labels, tickers, times and CAR as memory-mappable arrays. "
+                            "Reads the collection set with --target or LABEL_COLLECTION"))
+parser.add_argument("--features", type = int, default = 2**20,
+                    help = "used with --export: number of hashed feature columns of a new dataset (2**20 by default)")
+parser.add_argument("--dedup-index", help = ("adds the articles stored before near-duplicate detection was enabled "
+                                             "to the signature index"),
+                   action = "store_true")
+parser.add_argument("--migrate", help = ("converts event windows stored as lists of {date: close} dicts "
+                                         "to compact arrays of timestamps and closes"),
+                   action = "store_true")
+parser.add_argument("--snapshot", metavar = "DIR",
+                    help = ("appends articles inserted since the previous run to a local memory-mapped snapshot "
+                            "of article texts in DIR and flags the deleted ones. "
+                            "Used with --sweeper: refreshes the snapshot and reads articles from it "
+                            "instead of the database"))
+parser.add_argument("--import-bars", nargs = "+", metavar = "CSV",
+                    help = ("merges historical daily bars from CSV files (date, open, high, low, close, volume "
+                            "and an optional symbol column) into the local price store set with --price-store"))
+parser.add_argument("--price-store", metavar = "DIR", default = os.getenv('PRICE_STORE'),
+                    help = ("a local price store directory quotes are read from instead of Alpaca API "
+                            "(PRICE_STORE environment variable by default)"))
+parser.add_argument("--score", help = ("scores the sentiment of articles not scored yet (or whose text changed) with NLTK VADER, "
+                                       "sentence by sentence, across a pool of worker processes. "
+                                       "Scores are cached by article content, so unchanged texts are never scored twice"),
+                    action = "store_true")
+parser.add_argument("--workers", type = int,
+                    help = "used with --score: number of worker processes (number of CPUs by default)")
+parser.add_argument("--metrics-port", type = int,
+                    help = "serves live metrics in Prometheus text format at http://127.0.0.1:PORT/metrics")
+parser.add_argument("--metrics-file", 
+                    help = "writes a JSON snapshot of live metrics to this file periodically")
+parser.add_argument("--metrics-interval", type = float, default = 10,
+                    help = "seconds between JSON metrics snapshots (10 by default)")
+parser.add_argument("--profile", nargs = "?", const = "profiles", metavar = "DIR",
+                    help = ("records per-thread CPU profiles, stack samples and asyncio task timings and writes "
+                            "a merged report, a pstats file and a flamegraph-compatible stacks.folded file "
+                            "to a timestamped sub-directory of DIR ('profiles' by default)"))
+
+# worker processes of --score are started with the spawn method
+# import this module, so the command runs only when it is executed as a script
+if __name__ == '__main__':
+    args = parser.parse_args()
+    if len(sys.argv)==1:
+        parser.print_help(sys.stderr)
+        sys.exit(1)
+
+    # wraps thread targets so that each thread gets a CPU profile of its own
+    profiled = lambda target: target
+    if args.profile:
+        import atexit
+        from data_digger.profiling import Profiler
+        profiler = Profiler(args.profile)
+        profiler.start()
+        profiled = profiler.wrap
+        atexit.register(profiler.stop)
+
+    if args.metrics_port:
+        metrics.registry.serve(args.metrics_port)
+    if args.metrics_file:
+        metrics_stop = metrics.registry.dump_every(args.metrics_file, args.metrics_interval)
+
+    if args.price_store:
+        import data_digger.Alpaca as alp
+        from data_digger.price_store import PriceStore
+        alp.Alpaca.price_store = PriceStore(args.price_store)
+
+    #instatiates Mongo_module class
+    handler = Mongo_module.MongoHandler ("EVENT_STUDY")
+
+    if args.articles:
+        handler.crawler(stream = args.stream)
 
-args = parser.parse_args()
-if len(sys.argv)==1:
-    parser.print_help(sys.stderr)
-    sys.exit(1)
-
-#instatiates Mongo_module class
-handler = Mongo_module.MongoHandler ("EVENT_STUDY")
-
-if args.articles:
-    handler.crawler()
-
-elif args.quotes:    
-    from threading import Thread, Lock, Condition
-    start_time = time.time()
-    q = []
-    lock = Lock()
-    full_= Condition(lock)
-    empty_ = Condition(lock)
-    # a single producer thread retrieving documents from a database
-    m = Thread(target = handler.find_item, args =(q, full_, empty_))
-    m.start()
-    threads = []
-    # multiple consumer threads calling the API and dumping results to a databse 
-    for l in range (10):
-        t = Thread(target = handler.updater, args= (q, full_, empty_))
-        t.start()
-        threads.append(t)
-    m.join()
-
-    for t in threads:
-        t.join()
-
-    print("--- %s seconds ---" % (time.time() - start_time))
+    elif args.quotes:    
+        from threading import Thread, Lock, Condition, Event
+        from data_digger.checkpoint import Checkpoint
+        start_time = time.time()
+        q = []
+        lock = Lock()
+        full_= Condition(lock)
+        empty_ = Condition(lock)
+        # one checkpoint per worker, saving the lease owner,
+        # so that a resumed run takes over the leases of its own crashed run only
+        checkpoint = Checkpoint(handler.meta, f"quotes:{args.worker_id}", owner = handler.owner)
+        resume = checkpoint.load() if args.resume else None
+        if args.resume and resume is None:
+            logger.info ("No checkpoint found, starting from the beginning")
+        # keeps leases on the claimed documents alive while they wait in the queue
+        stop = Event()
+        hb = Thread(target = handler.heartbeat, args = (stop,), daemon = True)
+        hb.start()
+        cp = Thread(target = checkpoint.run, args = (stop,), daemon = True)
+        cp.start()
+        # a single producer thread retrieving documents from a database
+        m = Thread(target = profiled(handler.find_item), args =(q, full_, empty_), 
+                   kwargs = {"checkpoint": checkpoint, "resume": resume})
+        m.start()
+        threads = []
+        # multiple consumer threads calling the API and dumping results to a databse 
+        for l in range (10):
+            t = Thread(target = profiled(handler.updater), args= (q, full_, empty_), kwargs = {"checkpoint": checkpoint})
+            t.start()
+            threads.append(t)
+        m.join()
+
+        for t in threads:
+            t.join()
+        stop.set()
+        cp.join()
+        # a failed run keeps its resume position
+        if checkpoint.failed:
+            logger.warning ("The run did not complete, restart it with --resume")
+        else:
+            checkpoint.clear()
+
+        logger.info("--- %s seconds ---", time.time() - start_time)
     
-elif args.label:
-    handler.labelling()
-
-elif args.sweeper:
-    from threading import Thread
-    from queue import Queue
-    # conditional import of functions which bin sentences and delete short articles
-    from data_digger.stack.misc_functions import collect_bins, deleter
-    # a queue class instance to put database documents in 
-    q = Queue()
-    cursor = handler.db[handler.collection].find()
-    bins = collect_bins(handler.db, handler.collection)
-    print ("bins collected. Enqueuing..")
-    for l in range(10):
-        w = Thread (target = deleter, args = (q, bins, handler.db, handler.collection))
-        w.start()
-    for i in cursor:
-        q.put(i)
-    print ("all items put into queue")
+    elif args.label:
+        handler.labelling(incremental = args.incremental, target = args.target, threshold = args.threshold)
+
+    elif args.events:
+        handler.backfill_events(threshold = args.threshold)
+
+    elif args.follow:
+        handler.follow(poll_interval = args.poll_interval)
+
+    elif args.export:
+        import data_digger.Alpaca as alp
+        from data_digger.exporter import DatasetExporter
+        exporter = DatasetExporter(args.export, n_features = args.features)
+        exporter.export(handler.db[args.target or handler.label_target], handler.field, alp.Alpaca.returns)
+
+    elif args.dedup_index:
+        from data_digger.stack.near_dup import NearDuplicateIndex
+        index = NearDuplicateIndex(handler.db[os.getenv('DEDUP_COLLECTION') or f'{handler.collection}_minhash'],
+                                   threshold = float(os.getenv('DEDUP_THRESHOLD', 0.7)))
+        logger.info ("%s articles indexed", index.backfill(handler.db[handler.collection]))
+
+    elif args.import_bars:
+        if not args.price_store:
+            parser.error("--import-bars requires --price-store or PRICE_STORE environment variable")
+        logger.info ("%s bars imported", alp.Alpaca.price_store.import_csv(args.import_bars))
+
+    elif args.migrate:
+        handler.migrate_windows()
+
+    elif args.score:
+        from data_digger.sentiment import SentimentScorer
+        scorer = SentimentScorer(handler.db[handler.collection],
+                                 handler.db[os.getenv('SENTIMENT_CACHE') or f'{handler.collection}_sentiment'],
+                                 workers = args.workers)
+        scorer.run()
+
+    elif args.sweeper:
+        import numpy as np
+        from threading import Thread, Event
+        from queue import Queue
+        # conditional import of functions which bin sentences and delete short articles
+        from data_digger.stack.misc_functions import collect_bins, text_bins, deleter
+        from data_digger.records import Article
+        from data_digger.checkpoint import Checkpoint
+        # a queue class instance to put database documents in,
+        # bounded, so that the cursor is read only as fast as the articles are checked
+        q = Queue(1000)
+        checkpoint = Checkpoint(handler.meta, "sweeper")
+        resume = checkpoint.load() if args.resume else None
+        if args.resume and resume is None:
+            logger.info ("No checkpoint found, starting from the beginning")
+        mark = resume and resume["watermark"]
+        # articles are read in "_id" order, so that everything below the watermark is known to be checked
+        if args.snapshot:
+            from data_digger.snapshot import CorpusSnapshot
+            snapshot = CorpusSnapshot(args.snapshot)
+            snapshot.refresh(handler.db[handler.collection])
+            cursor = snapshot.records()
+            if mark is not None:
+                redo = set(resume["inflight"])
+                cursor = (i for i in cursor if i._id > mark or i._id in redo)
+        else:
+            query = {}
+            if mark is not None:
+                query = {"$or": [{"_id": {"$gt": mark}}, {"_id": {"$in": resume["inflight"]}}]}
+            cursor = (Article(d["_id"], None, d.get("article", "")) 
+                      for d in handler.db[handler.collection].find(query, {"article": 1}, batch_size = 1000).sort("_id", 1))
+        if resume:
+            # the bins of the interrupted run, so that articles are checked the same way
+            bins = np.array(resume["bins"])
+        elif args.snapshot:
+            # the same distinct articles collect_bins concatenates
+            bins = text_bins("".join(dict.fromkeys(snapshot.texts())))
+        else:
+            bins = collect_bins(handler.db, handler.collection)
+        checkpoint.extra["bins"] = bins.tolist()
+        # saved for the streaming pipeline filtering short articles at crawl time
+        handler.meta.replace_one({"_id": "bins"}, {"bins": bins.tolist()}, upsert = True)
+        logger.info ("bins collected. Enqueuing..")
+        stop = Event()
+        cp = Thread(target = checkpoint.run, args = (stop,), daemon = True)
+        cp.start()
+        for l in range(10):
+            w = Thread (target = profiled(deleter), args = (q, bins, handler.db, handler.collection, checkpoint))
+            w.start()
+        try:
+            for i in cursor:
+                checkpoint.claimed([i._id])
+                q.put(i)
+            logger.info ("all items put into queue")
+        except Exception as e:
+            # the deleting threads are still stopped below
+            logger.exception ("An error occurred while enqueuing: %s", e)
+            checkpoint.fail()
    
-    for c in range(10):
-        q.put(None)
-        q.task_done()
-    q.join()
-    print ("Deleting threads terminated")
+        for c in range(10):
+            q.put(None)
+            q.task_done()
+        q.join()
+        stop.set()
+        cp.join()
+        # a failed run keeps its resume position
+        if checkpoint.failed:
+            logger.warning ("The run did not complete, restart it with --resume")
+        else:
+            checkpoint.clear()
+        logger.info ("Deleting threads terminated")
+
+    elif args.snapshot:
+        from data_digger.snapshot import CorpusSnapshot
+        CorpusSnapshot(args.snapshot).refresh(handler.db[handler.collection])
+
+    if args.metrics_file:
+        # a final snapshot with the totals of the run
+        metrics_stop.set()
+        metrics.registry.dump(args.metrics_file)
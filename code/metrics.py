@@ -0,0 +1,243 @@
+'''a minimal thread-safe metrics registry:
+
+    * Counter, Gauge and Histogram metric types with optional labels
+    * Registry - keeps the metrics, renders them in Prometheus text format,
+      serves them over HTTP and dumps periodic JSON snapshots
+
+Stages report to the module-level `registry` instance.
+'''
+
+import json
+import os
+import threading
+import time
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _fmt(name, key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return name
+    inner = ','.join('{}="{}"'.format(k, str(v).replace('"', '\\"')) for k, v in pairs)
+    return f'{name}{{{inner}}}'
+
+
+class Counter:
+    '''a monotonically increasing value'''
+    kind = 'counter'
+
+    def __init__(self, name, help):
+        self.name, self.help = name, help
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, n=1, **labels):
+        '''adds n to the value of the given labels'''
+        k = _key(labels)
+        with self.lock:
+            self.values[k] = self.values.get(k, 0) + n
+
+    def samples(self):
+        '''returns a list of (sample name, value) tuples'''
+        with self.lock:
+            return [(_fmt(self.name, k), v) for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    '''a value that goes up and down'''
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        '''sets the value of the given labels'''
+        with self.lock:
+            self.values[_key(labels)] = value
+
+
+class Histogram:
+    '''counts observations in cumulative buckets, keeping their sum and count.
+
+    Attributes:
+        buckets: a sorted tuple of bucket upper bounds
+    '''
+    kind = 'histogram'
+    default_buckets = (.005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, name, help, buckets=None):
+        self.name, self.help = name, help
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        '''records a single observation, e.g. a latency in seconds'''
+        k = _key(labels)
+        with self.lock:
+            counts, total = self.values.get(k, ([0]*(len(self.buckets)+1), 0.0))
+            counts[bisect_left(self.buckets, value)] += 1
+            self.values[k] = (counts, total + value)
+
+    def time(self, **labels):
+        '''returns a context manager observing the time spent in its block'''
+        return _Timer(self, labels)
+
+    def samples(self):
+        out = []
+        with self.lock:
+            for k, (counts, total) in self.values.items():
+                cum = 0
+                for bound, c in zip(self.buckets + ('+Inf',), counts):
+                    cum += c
+                    out.append((_fmt(self.name + '_bucket', k, [('le', bound)]), cum))
+                out.append((_fmt(self.name + '_sum', k), total))
+                out.append((_fmt(self.name + '_count', k), cum))
+        return out
+
+
+class _Timer:
+    def __init__(self, hist, labels):
+        self.hist, self.labels = hist, labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.hist.observe(time.perf_counter() - self.start, **self.labels)
+
+
+class Registry:
+    '''keeps named metrics and exposes them.
+
+    Attributes:
+        metrics: a dict mapping metric names to metric instances
+    '''
+
+    def __init__(self):
+        self.metrics = {}
+        self.lock = threading.Lock()
+        self.dump_lock = threading.Lock()
+        self._last = (time.time(), {})
+
+    def _get(self, cls, name, help, **kwargs):
+        with self.lock:
+            if name not in self.metrics:
+                self.metrics[name] = cls(name, help, **kwargs)
+            return self.metrics[name]
+
+    def counter(self, name, help=''):
+        '''returns the counter with the given name, creating it if needed'''
+        return self._get(Counter, name, help)
+
+    def gauge(self, name, help=''):
+        '''returns the gauge with the given name, creating it if needed'''
+        return self._get(Gauge, name, help)
+
+    def histogram(self, name, help='', buckets=None):
+        '''returns the histogram with the given name, creating it if needed'''
+        return self._get(Histogram, name, help, buckets=buckets)
+
+    def render(self):
+        '''renders all metrics in Prometheus text exposition format'''
+        lines = []
+        for m in list(self.metrics.values()):
+            lines.append(f'# HELP {m.name} {m.help}')
+            lines.append(f'# TYPE {m.name} {m.kind}')
+            lines += [f'{name} {value}' for name, value in m.samples()]
+        return '\n'.join(lines) + '\n'
+
+    def snapshot(self):
+        '''returns a JSON-serializable dict of all samples,
+           with per-second rates of counters since the previous snapshot.
+        '''
+        now = time.time()
+        samples = {}
+        counters = {}
+        for m in list(self.metrics.values()):
+            for name, value in m.samples():
+                samples[name] = value
+                if m.kind == 'counter':
+                    counters[name] = value
+        since, last = self._last
+        elapsed = max(now - since, 1e-9)
+        rates = {k: (v - last.get(k, 0)) / elapsed for k, v in counters.items()}
+        self._last = (now, counters)
+        return {'time': now, 'samples': samples, 'rates_per_sec': rates}
+
+    def serve(self, port, host='127.0.0.1'):
+        '''serves the metrics at http://host:port/metrics from a daemon thread.
+
+        Returns:
+            the HTTP server instance
+        '''
+        registry = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server
+
+    def dump(self, path):
+        '''writes a JSON snapshot to a file.
+           The file is replaced atomically, so readers never see a partial snapshot.
+        '''
+        with self.dump_lock:
+            tmp = f'{path}.tmp'
+            with open(tmp, 'w') as f:
+                json.dump(self.snapshot(), f, indent=1)
+            os.replace(tmp, path)
+
+    def dump_every(self, path, interval=10, stop=None):
+        '''writes a JSON snapshot to a file every interval seconds from a daemon thread.
+
+        Args:
+            path: a file path string
+            interval: a number of seconds between snapshots
+            stop: an optional threading.Event stopping the thread
+
+        Returns:
+            the threading.Event stopping the thread
+        '''
+        stop = stop or threading.Event()
+
+        def dump():
+            while True:
+                self.dump(path)
+                if stop.wait(interval):
+                    break
+
+        threading.Thread(target=dump, daemon=True).start()
+        return stop
+
+
+registry = Registry()
+
+# metrics shared by the stages
+api_requests = registry.counter('alpaca_requests_total', 'Alpaca API requests by outcome')
+api_retries = registry.counter('alpaca_retries_total', 'Alpaca API request retries')
+api_latency = registry.histogram('alpaca_request_seconds', 'Alpaca API request latency')
+db_writes = registry.counter('db_writes_total', 'database writes by stage and operation')
+db_latency = registry.histogram('db_write_seconds', 'database write latency')
+queue_depth = registry.gauge('queue_depth', 'items waiting in a stage queue')
+documents = registry.counter('documents_processed_total', 'documents processed by stage')
+doc_latency = registry.histogram('document_seconds', 'time spent on a document by stage')
+items_scraped = registry.counter('items_scraped_total', 'items scraped by outcome')
+pool_connections = registry.gauge('mongo_pool_connections', 'open Mongo DB connections by server')
+pool_checked_out = registry.gauge('mongo_pool_checked_out', 'Mongo DB connections in use by server')
+pool_wait = registry.histogram('mongo_pool_wait_seconds', 'time waited for a Mongo DB connection')
+pool_failures = registry.counter('mongo_pool_failures_total', 'failed Mongo DB connection checkouts by reason')
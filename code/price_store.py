@@ -0,0 +1,204 @@
+'''this module keeps historical daily bars in a local store, so that quotes
+can be computed without requesting Alpaca API.
+
+The store directory holds:
+    * <SYMBOL>.bin - daily bars of a symbol as fixed-size records sorted by time,
+      the sorted time column serves as the date index searched with numpy.searchsorted
+    * manifest.json - numbers of bars and first and last bar times of each symbol
+
+Bar times are unix timestamps of midnight New York time of the bar date,
+the same as in Alpaca API daily bars. Symbol files are memory-mapped on reading.
+'''
+
+import json
+import os
+import threading
+import logging
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger("debugger")
+
+BAR = np.dtype([('t', '<i8'), ('o', '<f8'), ('h', '<f8'), ('l', '<f8'), ('c', '<f8'), ('v', '<f8')])
+
+# accepted CSV column names of each bar field
+COLUMNS = {
+    'symbol': ('symbol', 'ticker'),
+    't': ('date', 'timestamp', 'time', 't'),
+    'o': ('open', 'o'),
+    'h': ('high', 'h'),
+    'l': ('low', 'l'),
+    'c': ('close', 'c'),
+    'v': ('volume', 'v'),
+}
+
+
+class PriceStore:
+    '''a local memory-mapped store of daily bars.
+
+       Attributes:
+           path: a string path of the store directory
+           manifest: a dict mapping symbols to dicts of "rows", "first" and "last" bar times
+    '''
+
+    def __init__(self, path):
+        '''Inits PriceStore, loading the manifest of an existing store'''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {}
+        if os.path.exists(self._file('manifest.json')):
+            with open(self._file('manifest.json')) as f:
+                self.manifest = json.load(f)
+        self._maps = {}
+        self._lock = threading.Lock()
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def _bars_file(self, symbol):
+        return self._file(symbol.replace('/', '_') + '.bin')
+
+    def import_csv(self, paths, chunksize=10**6):
+        '''merges daily bars from CSV files into the store.
+
+           A file has one row per bar with date (or unix timestamp), open, high, low, close
+           and volume columns, and either a symbol column or bars of a single symbol
+           named after the file ("AAPL.csv"). Column names are case-insensitive.
+           Bars of dates already stored are replaced.
+
+           Args:
+               paths: a list of string paths of CSV files
+               chunksize: an integer number of CSV rows parsed at once
+
+           Returns:
+               an integer number of bars imported
+        '''
+
+        total = 0
+        for path in paths:
+            bars = {}
+            for chunk in pd.read_csv(path, chunksize=chunksize):
+                chunk = _normalize(chunk, Path(path).stem.upper())
+                for symbol, group in chunk.groupby('symbol', sort=False):
+                    records = np.empty(len(group), dtype=BAR)
+                    for name in BAR.names:
+                        records[name] = group[name].to_numpy()
+                    bars.setdefault(symbol, []).append(records)
+            for symbol, chunks in bars.items():
+                self._merge(symbol, np.concatenate(chunks))
+                total += sum(len(c) for c in chunks)
+            self._save_manifest()
+            logger.info("%s symbols imported from %s", len(bars), path)
+        return total
+
+    def _merge(self, symbol, records):
+        if symbol in self.manifest:
+            records = np.concatenate((self._load(symbol), records))
+        records = records[np.argsort(records['t'], kind='stable')]
+        # keeps the last imported bar of each date
+        records = records[np.append(records['t'][1:] != records['t'][:-1], True)]
+        tmp = self._bars_file(symbol) + '.tmp'
+        records.tofile(tmp)
+        os.replace(tmp, self._bars_file(symbol))
+        self.manifest[symbol] = {'rows': len(records), 'first': int(records['t'][0]), 'last': int(records['t'][-1])}
+        with self._lock:
+            self._maps.pop(symbol, None)
+
+    def _save_manifest(self):
+        with open(self._file('manifest.json.tmp'), 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self._file('manifest.json.tmp'), self._file('manifest.json'))
+
+    def _load(self, symbol):
+        '''returns a memory-mapped array of the bars of a symbol, None if there are none'''
+        with self._lock:
+            if symbol not in self._maps:
+                rows = self.manifest.get(symbol, {}).get('rows', 0)
+                self._maps[symbol] = np.memmap(self._bars_file(symbol), dtype=BAR, mode='r',
+                                               shape=(rows,)) if rows else None
+            return self._maps[symbol]
+
+    def __contains__(self, symbol):
+        return symbol in self.manifest
+
+    def bars(self, symbol, start=None, end=None, limit=None):
+        '''looks up daily bars of a symbol.
+
+           Args:
+               symbol: a string stock ticker
+               start, end: unix timestamps bounding bar times (inclusive), unbounded if None
+               limit: an integer max number of bars, the latest ones are kept
+
+           Returns:
+               a list of dicts with daily bar values, the same as Alpaca API returns
+        '''
+
+        records = self._load(symbol)
+        if records is None:
+            return []
+        t = records['t']
+        lo = 0 if start is None else np.searchsorted(t, start, side='left')
+        hi = len(t) if end is None else np.searchsorted(t, end, side='right')
+        if limit is not None:
+            lo = max(lo, hi - limit)
+        return [{'t': int(r[0]), 'o': float(r[1]), 'h': float(r[2]), 'l': float(r[3]),
+                 'c': float(r[4]), 'v': float(r[5])} for r in records[lo:hi].tolist()]
+
+    def event_windows(self, ticker, start, end, limit=30, benchmark='SPY'):
+        '''looks up bars of a ticker and the market benchmark the same way
+           Alpaca.make_request requests them from the API.
+
+           The API bounds bars by dates, so both windows take in the bars
+           of the start date, and the window after the publication the bars of the end date.
+
+           Args:
+               ticker: a string stock ticker
+               start, end: date (or datetime) objects of the event window bounds, New York time
+               limit: an integer number of bars up to the start of the window
+               benchmark: a string ticker of the market benchmark
+
+           Returns:
+               a tuple of dicts mapping the ticker and the benchmark to bars
+               before (up to start) and after (between start and end) the publication
+
+           Raises:
+               ValueError: an error occured if no bars are stored for the ticker in either window
+        '''
+
+        start, end = _midnight(start), _midnight(end)
+        before = {s: self.bars(s, end=start, limit=limit) for s in (ticker, benchmark)}
+        after = {s: self.bars(s, start=start, end=end) for s in (ticker, benchmark)}
+        if not before[ticker] or not after[ticker]:
+            raise ValueError('invalid ticker!' + ticker)
+        return before, after
+
+
+def _midnight(day):
+    '''returns the bar timestamp of a date, unix seconds of midnight New York time'''
+    return int(pd.Timestamp(day.year, day.month, day.day, tz='America/New_York').timestamp())
+
+
+def _normalize(chunk, default_symbol):
+    '''renames CSV columns to bar fields and converts dates to bar timestamps'''
+    columns = {c.strip().lower(): c for c in chunk.columns}
+    out = pd.DataFrame(index=chunk.index)
+    for field, names in COLUMNS.items():
+        found = next((columns[n] for n in names if n in columns), None)
+        if found is not None:
+            out[field] = chunk[found]
+        elif field == 'symbol':
+            out[field] = default_symbol
+        elif field == 'v':
+            out[field] = 0.0
+        else:
+            raise ValueError(f'no {names[0]} column in CSV')
+    if pd.api.types.is_numeric_dtype(out['t']):
+        out['t'] = pd.to_datetime(out['t'], unit='s', utc=True)
+    else:
+        out['t'] = pd.to_datetime(out['t'])
+    dates = out['t'].dt.tz_convert('America/New_York') if out['t'].dt.tz is not None \
+        else out['t'].dt.tz_localize('America/New_York')
+    out['t'] = (dates.dt.normalize() - pd.Timestamp(0, tz='UTC')) // pd.Timedelta(seconds=1)
+    out['symbol'] = out['symbol'].astype(str).str.upper()
+    return out
@@ -0,0 +1,177 @@
+'''a profiling mode for main.py sub-commands.
+
+Collects three kinds of data during a run:
+    * deterministic per-thread CPU profiles (cProfile), merged into one report
+    * sampled stacks of every thread in the "folded" format
+      understood by flamegraph.pl, speedscope and similar tools
+    * wall time of asyncio tasks by coroutine, from creation to completion,
+      for every event loop created during the run
+
+Usage:
+    profiler = Profiler('profiles')
+    profiler.start()
+    Thread(target=profiler.wrap(func)).start()
+    ...
+    profiler.stop()
+'''
+
+import asyncio
+import cProfile
+import io
+import logging
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime
+
+logger = logging.getLogger("debugger")
+
+
+class Profiler:
+    '''collects per-thread profiles, stack samples and asyncio task timings.
+
+    Attributes:
+        out_dir: a string path of the directory the report of this run is written to
+        interval: a float number of seconds between stack samples
+        profiles: a list of (thread name, cProfile.Profile) tuples
+        stacks: a Counter of folded stack strings
+        tasks: a dict mapping coroutine names to lists of task wall times
+    '''
+
+    def __init__(self, out_dir='profiles', interval=0.005):
+        '''Inits Profiler'''
+        self.out_dir = os.path.join(out_dir, datetime.now().strftime('%Y%m%d-%H%M%S'))
+        self.interval = interval
+        self.profiles = []
+        self.stacks = Counter()
+        self.tasks = defaultdict(list)
+        self.lock = threading.Lock()
+        self._stop = threading.Event()
+        self._main = None
+        self._sampler = None
+        self._started = None
+
+    def _profile(self):
+        '''enables a cProfile.Profile for the calling thread.
+           Returns None if the interpreter allows a single active profiler only (Python 3.12+),
+           in which case the thread is covered by stack samples alone.
+        '''
+        prof = cProfile.Profile()
+        try:
+            prof.enable()
+        except ValueError as e:
+            logger.info("CPU profile unavailable in %s: %s", threading.current_thread().name, e)
+            return None
+        with self.lock:
+            self.profiles.append((threading.current_thread().name, prof))
+        return prof
+
+    def wrap(self, target):
+        '''returns a function running target under a CPU profile of its own thread'''
+        def profiled(*args, **kwargs):
+            prof = self._profile()
+            try:
+                return target(*args, **kwargs)
+            finally:
+                if prof is not None:
+                    prof.disable()
+        return profiled
+
+    def start(self):
+        '''starts profiling the calling thread, sampling all threads
+           and timing the tasks of every event loop created from now on.
+        '''
+        self._started = time.perf_counter()
+        self._main = self._profile()
+        asyncio.set_event_loop_policy(_TimingPolicy(self))
+        self._sampler = threading.Thread(target=self._sample, name='profiler-sampler', daemon=True)
+        self._sampler.start()
+
+    def _sample(self):
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})'
+                                 .replace(';', ':'))
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)).replace(';', ':'))
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def task_factory(self, loop, coro, **kwargs):
+        '''an event loop task factory recording the wall time of each task'''
+        task = asyncio.Task(coro, loop=loop, **kwargs)
+        name = getattr(coro, '__qualname__', type(coro).__name__)
+        created = time.perf_counter()
+
+        def done(t):
+            with self.lock:
+                self.tasks[name].append(time.perf_counter() - created)
+        task.add_done_callback(done)
+        return task
+
+    def stop(self):
+        '''stops profiling and writes the report files:
+           report.txt, merged.prof (for pstats, snakeviz, etc.) and stacks.folded.
+
+        Returns:
+            the string path of the report directory
+        '''
+        if self._main is not None:
+            self._main.disable()
+        self._stop.set()
+        self._sampler.join()
+        os.makedirs(self.out_dir, exist_ok=True)
+        elapsed = time.perf_counter() - self._started
+
+        out = io.StringIO()
+        out.write(f'Wall time: {elapsed:.2f} s, threads profiled: {len(self.profiles)}, '
+                  f'stack samples: {sum(self.stacks.values())}\n\n')
+        with self.lock:
+            profiles = list(self.profiles)
+            tasks = {k: list(v) for k, v in self.tasks.items()}
+        if profiles:
+            merged = pstats.Stats(profiles[0][1], stream=out)
+            for name, prof in profiles[1:]:
+                merged.add(prof)
+            merged.dump_stats(os.path.join(self.out_dir, 'merged.prof'))
+            out.write('=== All threads, by cumulative time ===\n')
+            merged.sort_stats('cumulative').print_stats(40)
+            out.write('=== All threads, by own time ===\n')
+            merged.sort_stats('tottime').print_stats(40)
+            for name, prof in profiles:
+                out.write(f'=== Thread {name}, by own time ===\n')
+                pstats.Stats(prof, stream=out).sort_stats('tottime').print_stats(15)
+        out.write('=== asyncio tasks, by total wall time ===\n')
+        out.write(f"{'coroutine':<60}{'count':>8}{'total s':>10}{'mean ms':>10}{'max ms':>10}\n")
+        for name, times in sorted(tasks.items(), key=lambda kv: -sum(kv[1])):
+            out.write(f'{name[:59]:<60}{len(times):>8}{sum(times):>10.2f}'
+                      f'{1000*sum(times)/len(times):>10.1f}{1000*max(times):>10.1f}\n')
+        with open(os.path.join(self.out_dir, 'report.txt'), 'w') as f:
+            f.write(out.getvalue())
+        with open(os.path.join(self.out_dir, 'stacks.folded'), 'w') as f:
+            for stack, count in self.stacks.most_common():
+                f.write(f'{stack} {count}\n')
+        logger.info("Profile written to %s", self.out_dir)
+        return self.out_dir
+
+
+class _TimingPolicy(asyncio.DefaultEventLoopPolicy):
+    '''an event loop policy installing the profiler task factory on each new loop'''
+
+    def __init__(self, profiler):
+        super().__init__()
+        self.profiler = profiler
+
+    def new_event_loop(self):
+        loop = super().new_event_loop()
+        loop.set_task_factory(self.profiler.task_factory)
+        return loop
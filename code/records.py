@@ -0,0 +1,40 @@
+'''compact record types the stages keep in their queues instead of database documents.'''
+
+
+class Article:
+    '''the fields of an article document the stages read.
+
+       Slots keep an instance to a fraction of the size of the projected document dict.
+       Records can also be read like documents (record["article"]),
+       so the functions taking database documents take records as well.
+
+       Attributes:
+           _id: the id of the article document
+           time: a datetime of the publication (unix seconds if read from a snapshot)
+           article: a string article text
+    '''
+
+    __slots__ = ('_id', 'time', 'article')
+
+    # a projection of the fields stored in a record
+    fields = {'time': 1, 'article': 1}
+
+    def __init__(self, _id, time, article):
+        '''Inits Article'''
+        self._id = _id
+        self.time = time
+        self.article = article
+
+    @classmethod
+    def from_doc(cls, doc):
+        '''builds a record from a (projected) database document'''
+        return cls(doc['_id'], doc.get('time'), doc.get('article', ''))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key) from None
+
+    def __repr__(self):
+        return f'Article({self._id!r}, {self.time!r}, {self.article[:30]!r})'
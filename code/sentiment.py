@@ -0,0 +1,153 @@
+'''this module scores the sentiment of articles with NLTK VADER analyzer.
+
+Articles are split into sentences with misc_functions.tokenize, each sentence is scored
+and the article gets the mean scores of its sentences. Scoring is CPU-bound,
+so batches of articles are scored in worker processes, one analyzer per process.
+
+Scores are cached by a hash of the article text (and the scoring version),
+so an article republished or re-scraped unchanged is never scored twice.
+The hash is also stored with the scores, so an article whose text has changed is scored again.
+VADER lexicon is needed: python -m nltk.downloader vader_lexicon punkt
+'''
+
+import os
+import hashlib
+import time
+import logging
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pymongo
+from data_digger import metrics
+
+logger = logging.getLogger("debugger")
+
+# changed whenever scores are computed differently, which invalidates the cache
+VERSION = 'vader-mean-1'
+KEYS = ('compound', 'pos', 'neu', 'neg')
+
+_analyzer = None
+
+
+def _load():
+    '''loads the analyzer of the current process'''
+    global _analyzer
+    if _analyzer is None:
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+        _analyzer = SentimentIntensityAnalyzer()
+    return _analyzer
+
+
+def score_text(text):
+    '''scores an article by the mean VADER scores of its sentences.
+
+       Args:
+           text: an article (a string variable)
+
+       Returns:
+           a dict of mean "compound", "pos", "neu" and "neg" scores
+           and the number of "sentences" scored
+    '''
+
+    from data_digger.stack.misc_functions import tokenize
+    analyzer = _load()
+    scores = [analyzer.polarity_scores(s) for s in tokenize(text)]
+    out = {k: (sum(s[k] for s in scores) / len(scores) if scores else 0.0) for k in KEYS}
+    out['sentences'] = len(scores)
+    return out
+
+
+def score_batch(texts):
+    '''scores a list of articles in a worker process'''
+    return [score_text(t) for t in texts]
+
+
+def content_hash(text):
+    '''returns a hex digest of an article text and the scoring version'''
+    return hashlib.blake2b(f'{VERSION}\0{text}'.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class SentimentScorer:
+    '''scores the articles not scored yet across a process pool.
+
+       The main process reads articles, looks up the cache and writes results,
+       while worker processes score the cache misses of up to 2 batches per worker ahead.
+
+       Attributes:
+           collection: a pymongo.collection instance with the articles
+           cache: a pymongo.collection instance mapping content hashes to scores
+           field: a string name of the database field the scores are stored in
+           workers: an integer number of worker processes
+           batch_size: an integer number of articles read, scored and written at once
+    '''
+
+    def __init__(self, collection, cache, field='sentiment', workers=None, batch_size=200):
+        '''Inits SentimentScorer'''
+        self.collection = collection
+        self.cache = cache
+        self.field = field
+        self.workers = workers or os.cpu_count()
+        self.batch_size = batch_size
+
+    def batches(self):
+        '''yields lists of (article, content hash) tuples of the articles without scores
+           or with scores of another text, near duplicates excluded
+        '''
+        stored = f'{self.field}_hash'
+        query = {'duplicate_of': {'$exists': False}}
+        batch = []
+        for doc in self.collection.find(query, {'article': 1, stored: 1}, batch_size=self.batch_size):
+            h = content_hash(doc.get('article', ''))
+            if doc.get(stored) == h:
+                continue
+            batch.append((doc, h))
+            if len(batch) >= self.batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def run(self):
+        '''scores all articles without scores or with scores of another text.
+
+           Returns:
+               a tuple of integer numbers of articles scored and cache hits
+        '''
+
+        # fails early if NLTK data is missing, rather than in every worker
+        _load()
+        scored = hits = 0
+        pending = deque()
+        # forking would copy the locks held by MongoClient monitors and the logging thread
+        with ProcessPoolExecutor(self.workers, mp_context=multiprocessing.get_context('spawn')) as pool:
+            for pairs in self.batches():
+                batch, hashes = [d for d, h in pairs], [h for d, h in pairs]
+                cached = {c['_id']: c['scores'] for c in self.cache.find({'_id': {'$in': hashes}})}
+                # each distinct text is scored once
+                misses = list(dict.fromkeys(h for h in hashes if h not in cached))
+                texts = {h: d.get('article', '') for h, d in zip(hashes, batch)}
+                future = pool.submit(score_batch, [texts[h] for h in misses]) if misses else None
+                pending.append((batch, hashes, cached, misses, future, time.perf_counter()))
+                hits += sum(h in cached for h in hashes)
+                while len(pending) > 2*self.workers:
+                    scored += self._write(*pending.popleft())
+            while pending:
+                scored += self._write(*pending.popleft())
+        logger.info("%s articles scored, %s cache hits", scored, hits)
+        return scored, hits
+
+    def _write(self, batch, hashes, cached, misses, future, started):
+        '''waits for the scores of a batch and writes them with the cache entries'''
+        if future is not None:
+            fresh = dict(zip(misses, future.result()))
+            self.cache.bulk_write([pymongo.ReplaceOne({'_id': h}, {'scores': s}, upsert=True)
+                                   for h, s in fresh.items()], ordered=False)
+            cached.update(fresh)
+        ops = [pymongo.UpdateOne({'_id': d['_id']}, {'$set': {self.field: cached[h], f'{self.field}_hash': h}})
+               for d, h in zip(batch, hashes)]
+        with metrics.db_latency.time(stage='sentiment'):
+            self.collection.bulk_write(ops, ordered=False)
+        metrics.db_writes.inc(len(ops), stage='sentiment', op='update')
+        metrics.documents.inc(len(batch), stage='sentiment')
+        metrics.doc_latency.observe((time.perf_counter() - started) / len(batch), stage='sentiment')
+        return len(batch)
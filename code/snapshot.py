@@ -0,0 +1,153 @@
+'''this module keeps a local snapshot of the article corpus for offline passes.
+
+The snapshot directory holds:
+    * corpus.bin - UTF-8 article texts concatenated back to back
+    * index.bin - one fixed-size record per article: id, publication time,
+      offset and length of its text in corpus.bin and a deleted flag
+    * manifest.json - numbers of records and bytes written and the last snapshotted "_id"
+
+Both files are memory-mapped on reading, so an article is sliced out of the corpus
+without copying it (CorpusSnapshot.raw). Refreshes only append articles inserted
+since the previous one and flag the deleted ones.
+'''
+
+import json
+import mmap
+import os
+import logging
+from datetime import timezone
+import numpy as np
+from bson import ObjectId
+from data_digger.records import Article
+
+logger = logging.getLogger("debugger")
+
+# ids are raw ObjectId bytes, 'S12' would strip trailing NUL bytes
+RECORD = np.dtype([('id', 'V12'), ('time', '<i8'), ('offset', '<i8'), ('length', '<i8'), ('deleted', 'u1')])
+
+
+class CorpusSnapshot:
+    '''a local memory-mapped copy of article texts and key fields.
+
+       Attributes:
+           path: a string path of the snapshot directory
+           manifest: a dict of snapshot state
+           index: a numpy memmap of index records, None if the snapshot is empty
+    '''
+
+    def __init__(self, path):
+        '''Inits CorpusSnapshot, loading an existing snapshot if any'''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.manifest = {'rows': 0, 'bytes': 0, 'last_id': None}
+        if os.path.exists(self._file('manifest.json')):
+            with open(self._file('manifest.json')) as f:
+                self.manifest = json.load(f)
+        self.index = None
+        self._corpus = None
+
+    def _file(self, name):
+        return os.path.join(self.path, name)
+
+    def refresh(self, collection, prune=True, batch_size=1000):
+        '''appends articles inserted since the previous refresh, in "_id" order.
+
+           Args:
+               collection: a pymongo.collection instance with the articles
+               prune: a boolean flagging articles no longer in the collection as deleted,
+                      which costs one scan of "_id" values only
+               batch_size: an integer cursor batch size and number of articles appended at once
+
+           Returns:
+               an integer number of articles appended
+        '''
+
+        self.close()
+        # drops whatever an interrupted refresh appended after the last manifest
+        for name, size in (('corpus.bin', self.manifest['bytes']),
+                           ('index.bin', self.manifest['rows'] * RECORD.itemsize)):
+            with open(self._file(name), 'ab') as f:
+                f.truncate(size)
+        query = {}
+        if self.manifest['last_id']:
+            query['_id'] = {'$gt': ObjectId(self.manifest['last_id'])}
+        cursor = collection.find(query, {'article': 1, 'time': 1}, batch_size=batch_size).sort('_id', 1)
+        appended = 0
+        texts, records = [], []
+        for doc in cursor:
+            texts.append(doc.get('article', '').encode('utf-8'))
+            time = doc.get('time')
+            records.append((doc['_id'].binary,
+                            int(time.replace(tzinfo=timezone.utc).timestamp()) if time else 0,
+                            0, len(texts[-1]), 0))
+            if len(texts) >= batch_size:
+                appended += self._append(texts, records, str(doc['_id']))
+                texts, records = [], []
+        if texts:
+            appended += self._append(texts, records, str(doc['_id']))
+        if prune and self.manifest['rows']:
+            alive = set(d['_id'].binary for d in collection.find({}, {'_id': 1}, batch_size=10000))
+            index = np.memmap(self._file('index.bin'), dtype=RECORD, mode='r+', shape=(self.manifest['rows'],))
+            gone = np.array([i.tobytes() not in alive for i in index['id']], dtype=bool)
+            index['deleted'][gone] = 1
+            index.flush()
+            del index
+        logger.info("%s articles appended to the snapshot, %s in total", appended, self.manifest['rows'])
+        return appended
+
+    def _append(self, texts, records, last_id):
+        records = np.array(records, dtype=RECORD)
+        lengths = records['length']
+        records['offset'] = self.manifest['bytes'] + np.concatenate(([0], np.cumsum(lengths)[:-1]))
+        for name, data in (('corpus.bin', b''.join(texts)), ('index.bin', records.tobytes())):
+            with open(self._file(name), 'ab') as f:
+                f.write(data)
+                f.flush()
+                os.fsync(f.fileno())
+        self.manifest['rows'] += len(records)
+        self.manifest['bytes'] += int(lengths.sum())
+        self.manifest['last_id'] = last_id
+        with open(self._file('manifest.json.tmp'), 'w') as f:
+            json.dump(self.manifest, f)
+        os.replace(self._file('manifest.json.tmp'), self._file('manifest.json'))
+        return len(records)
+
+    def open(self):
+        '''memory-maps the snapshot files for reading'''
+        if self.index is None and self.manifest['rows']:
+            self.index = np.memmap(self._file('index.bin'), dtype=RECORD, mode='r', shape=(self.manifest['rows'],))
+            with open(self._file('corpus.bin'), 'rb') as f:
+                self._corpus = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if self.manifest['bytes'] else b''
+        return self
+
+    def close(self):
+        '''unmaps the snapshot files'''
+        if isinstance(self._corpus, mmap.mmap):
+            self._corpus.close()
+        self.index = self._corpus = None
+
+    def __len__(self):
+        return self.manifest['rows']
+
+    def raw(self, i):
+        '''returns a zero-copy memoryview of the UTF-8 text of the i-th article'''
+        self.open()
+        rec = self.index[i]
+        return memoryview(self._corpus)[rec['offset']:rec['offset'] + rec['length']]
+
+    def text(self, i):
+        '''returns the text of the i-th article'''
+        return str(self.raw(i), 'utf-8')
+
+    def texts(self):
+        '''yields the texts of the articles not deleted'''
+        self.open()
+        for i in np.flatnonzero(self.index['deleted'] == 0) if self.manifest['rows'] else []:
+            yield self.text(i)
+
+    def records(self):
+        '''yields Article records of the articles not deleted, with unix seconds as "time"'''
+        self.open()
+        for i in np.flatnonzero(self.index['deleted'] == 0) if self.manifest['rows'] else []:
+            rec = self.index[i]
+            yield Article(ObjectId(rec['id'].tobytes()), int(rec['time']), self.text(i))
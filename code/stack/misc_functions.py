@@ -3,13 +3,24 @@
     * ticker_extraction - searches for stock tickers using regex
     * tokenize- tokenizes text into sentences
     * collect_bins - bins sentence length values
+    * text_bins - bins sentence length values of a given text
+    * is_short - checks whether an article is composed from shortest sentences
     * deleter - deletes articles composed from shortest sentences 
+    * label_of - labels abnormal returns with '1' or '0'
+    * event_row - builds a per-ticker event row of a quoted article
+    * compact_window - converts a legacy event window to parallel arrays
+    * event_window - reads an event window into numpy arrays
 '''
 
 import re 
+import logging
 import numpy as np
+from datetime import datetime
 from itertools import chain,product,starmap
 from nltk import sent_tokenize
+from data_digger import metrics
+
+logger = logging.getLogger("debugger")
 
 def ticker_extraction (text):
     '''looks up for NYSE and NASDAQ stock tickers 
@@ -72,22 +83,24 @@ def collect_bins (db, collection):
            a numpy array of bins
     '''
     
-    view = db[collection].aggregate( [  {"$group":{
-                                        "_id": None, 
-                                        "mergedDocs": {"$addToSet": "$article"}
-                                    }},
-                                    {"$project":{
-                                            "final":{
-                                                "$reduce": {
-                                                    "input": "$mergedDocs",
-                                                    "initialValue": "",
-                                                    "in": { "$concat" : ["$$value", "$$this"]}
-                                                                }
-                                                            }
-                                                     }}
-                                                  ])
-                                   
-    doc = view.next()['final']
+    # distinct articles are concatenated on the client: a server-side $group 
+    # into a single document fails once the corpus exceeds 16 MB
+    cursor = db[collection].find({}, {"_id": 0, "article": 1}, batch_size=1000)
+    doc = "".join(dict.fromkeys(d.get("article", "") for d in cursor))
+    return text_bins(doc)
+
+
+def text_bins(doc):
+    '''feeds a text into the sentence tokenizer and creates 
+       an array of bins between min and max sentence length values.
+       
+       Args:
+           doc: a string of whole corpus of articles
+           
+       Returns:
+           a numpy array of bins
+    '''
+    
     total_sents = tokenize(doc)
     x = np.array([(len(s)) for s in total_sents])
     min_edge, max_edge = np.min(x), np.max(x)
@@ -95,36 +108,145 @@ def collect_bins (db, collection):
     return bins
               
 
-def deleter(q,bins, db, col):
+def is_short(text, bins):
+    '''checks whether every sentence of an article belongs to the leftmost bin.
+    
+       Args:
+            text: an article to be checked (a string variable)
+            bins: an array of bins returned by collect_bins
+       
+       Returns:
+            a boolean
+    '''
+    
+    toks = tokenize(text)
+    digit = [np.digitize(len (tok), bins) for tok in toks]
+    return all(d==1 for d in digit)
+
+
+def deleter(q,bins, db, col, checkpoint=None):
     '''iterates through s queue and deletes articles 
        every sentence in which belongs to the leftmost bin.
        
        Args:
-            q: a queue object with database documents already put in
+            q: a queue object with Article records or database documents already put in
             bins: an array of bins to index sentences with
             db: a pymongo.database in which the data is stored
             collection: a string name of Mongo collection,
             in which the data is stored. 
+            checkpoint: an optional Checkpoint instance the checked ids are reported to,
+            flagged as failed if an article could not be checked
     '''
     
     while True:
         item = q.get()
         if (item == None):
-            print('item is none! ')
+            logger.debug('item is none! ')
             break        
-        toks = tokenize(item['article'])
-        digit = [np.digitize(len (tok), bins) for tok in toks]
-        short = all(d==1 for d in digit)
-        if short is True:
-            try:
-                db[col].delete_one( { "_id":item['_id']})
-            except Exception as e:
-                logger.exception ("An error occurred: %s", getattr(e, "__dict__", {}))  
-        q.task_done()
+        metrics.queue_depth.set(q.qsize(), stage='sweeper')
+        try:
+            if is_short(item['article'], bins):
+                with metrics.db_latency.time(stage='sweeper'):
+                    db[col].delete_one( { "_id":item['_id']})
+                metrics.db_writes.inc(stage='sweeper', op='delete')
+        except Exception as e:
+            logger.exception ("An error occurred: %s", getattr(e, "__dict__", {}) or e)  
+            # left in flight, so that a resumed run checks the article again
+            if checkpoint is not None:
+                checkpoint.fail()
+        else:
+            if checkpoint is not None:
+                checkpoint.done(item['_id'])
+        finally:
+            metrics.documents.inc(stage='sweeper')
+            q.task_done()
 
 
-# In[ ]:
+def label_of(car, threshold):
+    '''labels cumulative abnormal returns the same way 
+       as the MongoHandler.label_stages aggregation does.
+       
+       Args:
+           car: a float value of cumulative abnormal returns (in per cents)
+           threshold: a float label threshold (in per cents)
+       
+       Returns:
+           '1' if the absolute value of returns is greater than the threshold,
+           '0' if it is less, 'None' otherwise
+    '''
+    
+    if car is None:
+        return "None"
+    if car < -threshold or car > threshold:
+        return "1"
+    if -threshold < car < threshold:
+        return "0"
+    return "None"
 
 
+def event_row(article_id, time, quote, returns, threshold):
+    '''builds a row of the events collection, the same shape 
+       as MongoHandler.backfill_events aggregates.
+       
+       Args:
+           article_id: the id of the article document
+           time: a datetime of the publication
+           quote: a dict returned by Alpaca.OLS_method
+           returns: a string name of the abnormal returns key of the quote
+           threshold: a float label threshold (in per cents)
+       
+       Returns:
+           a dict keyed by the article id and the ticker
+    '''
+    
+    car = quote.get(returns)
+    return {'_id': {'article': article_id, 'ticker': quote['ticker']},
+            'ticker': quote['ticker'],
+            'time': time,
+            'alpha': quote.get('alpha'),
+            'beta': quote.get('beta'),
+            'car': car,
+            'label': label_of(car, threshold)}
+
+
+def compact_window(quote):
+    '''converts the event window of a quotes entry stored in the legacy format,
+       a list of single-key dicts {str(datetime): close}, to parallel arrays
+       of integer timestamps and float closes. 
+       
+       Legacy keys were written with datetime.fromtimestamp, i.e. in local time,
+       so the conversion should be run in the same timezone the data was collected in.
+       
+       Args:
+           quote: a dict returned by Alpaca.OLS_method and stored in the database
+           
+       Returns:
+           a copy of the dict with a compact event window, 
+           or the dict itself if it is compact already
+    '''
+    
+    window = quote.get('event_window')
+    if not isinstance(window, list):
+        return quote
+    pairs = [next(iter(bar.items())) for bar in window]
+    compact = dict(quote)
+    compact['event_window'] = {'t': [int(datetime.fromisoformat(k).timestamp()) for k, c in pairs],
+                               'c': [float(c) for k, c in pairs]}
+    return compact
 
 
+def event_window(quote):
+    '''reads the event window of a quotes entry into numpy arrays.
+       Both compact and legacy formats are accepted.
+       
+       Args:
+           quote: a dict returned by Alpaca.OLS_method and stored in the database
+       
+       Returns:
+           a tuple of an int64 array of unix timestamps 
+           and a float64 array of close prices
+    '''
+    
+    window = compact_window(quote)['event_window']
+    return (np.asarray(window['t'], dtype=np.int64),
+            np.asarray(window['c'], dtype=np.float64))
@@ -0,0 +1,140 @@
+'''this module detects near-duplicate articles with MinHash signatures
+and locality-sensitive hashing (LSH):
+
+    * MinHasher - builds MinHash signatures of word shingles and their LSH band keys
+    * NearDuplicateIndex - keeps signatures in a Mongo collection indexed by band keys
+      and looks up the most similar stored article
+'''
+
+import re
+import zlib
+import hashlib
+import numpy as np
+from bson import Binary
+
+# a Mersenne prime small enough for a*h+b to fit into uint64 with 32-bit hashes
+PRIME = np.uint64((1 << 31) - 1)
+
+
+class MinHasher:
+    '''builds MinHash signatures of articles.
+
+       Attributes:
+           num_perm: an integer number of hash permutations (signature length)
+           bands: an integer number of LSH bands, num_perm must be divisible by it
+           shingle: an integer number of words in a shingle
+    '''
+
+    def __init__(self, num_perm=128, bands=32, shingle=3, seed=1):
+        '''Inits MinHasher'''
+        if num_perm % bands:
+            raise ValueError('num_perm must be divisible by bands')
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle = shingle
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, int(PRIME), size=num_perm).astype(np.uint64)
+        self.b = rng.randint(0, int(PRIME), size=num_perm).astype(np.uint64)
+
+    def shingles(self, text):
+        '''splits a text into a set of lowercase word k-grams'''
+        words = re.findall(r'\w+', text.lower())
+        k = min(self.shingle, len(words)) or 1
+        return {' '.join(words[i:i+k]) for i in range(max(len(words)-k+1, 1))}
+
+    def signature(self, text):
+        '''returns a MinHash signature of a text as a uint32 numpy array'''
+        h = np.fromiter((zlib.crc32(s.encode()) for s in self.shingles(text)), dtype=np.uint64)
+        return ((np.outer(self.a, h) + self.b[:, None]) % PRIME).min(axis=1).astype(np.uint32)
+
+    def band_keys(self, sig):
+        '''returns a list of int64 LSH keys, one per band of a signature.
+           The band number is hashed in, so equal rows of different bands never collide.
+        '''
+        keys = []
+        for i in range(self.bands):
+            chunk = sig[i*self.rows:(i+1)*self.rows].tobytes()
+            digest = hashlib.blake2b(chunk, digest_size=8, salt=i.to_bytes(8, 'little')).digest()
+            keys.append(int.from_bytes(digest, 'little', signed=True))
+        return keys
+
+    @staticmethod
+    def similarity(sig1, sig2):
+        '''estimates Jaccard similarity of two texts by their signatures'''
+        return float(np.mean(sig1 == sig2))
+
+
+class NearDuplicateIndex:
+    '''a persisted LSH index of article signatures.
+
+       Each document of the index collection stores an article id,
+       its signature and its band keys, with a multikey index on the band keys.
+
+       Attributes:
+           collection: a pymongo.collection instance storing the signatures
+           hasher: a MinHasher instance
+           threshold: a float min estimated similarity of near duplicates
+    '''
+
+    def __init__(self, collection, hasher=None, threshold=0.7):
+        '''Inits NearDuplicateIndex and makes sure the band keys are indexed'''
+        self.collection = collection
+        self.hasher = hasher or MinHasher()
+        self.threshold = threshold
+        self.collection.create_index('bands')
+
+    def find(self, sig):
+        '''looks up the stored article most similar to a signature.
+
+           Returns:
+               a tuple of the article id and the estimated similarity,
+               or None if no stored article reaches the threshold
+        '''
+        best = None
+        for doc in self.collection.find({'bands': {'$in': self.hasher.band_keys(sig)}}, {'sig': 1}):
+            sim = self.hasher.similarity(sig, np.frombuffer(doc['sig'], dtype=np.uint32))
+            if sim >= self.threshold and (best is None or sim > best[1]):
+                best = (doc['_id'], sim)
+        return best
+
+    def add(self, article_id, sig):
+        '''stores the signature of an article'''
+        self.collection.replace_one({'_id': article_id},
+                                    {'sig': Binary(sig.tobytes()), 'bands': self.hasher.band_keys(sig)},
+                                    upsert=True)
+
+    def check(self, article_id, text):
+        '''looks up near duplicates of an article and stores its signature if it is original.
+
+           Args:
+               article_id: an id the article is (or is going to be) stored under
+               text: the article text
+
+           Returns:
+               the id of the article this one duplicates, or None
+        '''
+        sig = self.hasher.signature(text)
+        dup = self.find(sig)
+        if dup is not None:
+            return dup[0]
+        self.add(article_id, sig)
+        return None
+
+    def backfill(self, articles, batch_size=500):
+        '''indexes articles stored before the index existed.
+
+           Args:
+               articles: a pymongo.collection instance with the articles
+               batch_size: an integer cursor batch size
+
+           Returns:
+               an integer number of articles indexed
+        '''
+        known = set(d['_id'] for d in self.collection.find({}, {'_id': 1}))
+        count = 0
+        for doc in articles.find({'duplicate_of': {'$exists': False}}, {'article': 1}, batch_size=batch_size):
+            if doc['_id'] not in known:
+                self.add(doc['_id'], self.hasher.signature(doc['article']))
+                count += 1
+        return count
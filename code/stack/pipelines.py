@@ -1,15 +1,25 @@
 
 
+import asyncio
+import time
 import pymongo
 import dns
 import logging
+from bson import ObjectId
 from itemadapter import ItemAdapter
 from scrapy.exceptions import DropItem
 from scrapy import settings
+from scrapy.utils.defer import deferred_from_coro
 from functools import partial
-from datetime import datetime
+from collections import deque
 #imports the function searching for stock tickers in a given text 
-from data_digger.stack.misc_functions import ticker_extraction
+from data_digger.stack.misc_functions import ticker_extraction, is_short, label_of, event_row
+from data_digger.stack.near_dup import NearDuplicateIndex
+import data_digger.Alpaca as alp
+from data_digger import metrics
+from data_digger.connection import get_client
+
+logger = logging.getLogger("debugger")
 
 
 
@@ -21,16 +31,34 @@ class StackPipeline(object):
            mongo_collection= a Mongo collection string name in which items should be written
            mongo_db = a Mongo database name in which items should be written
            db = a pymongo.database instance
-           client = a MongoClient instance
+           client = the MongoClient instance shared by the process
            db = a pymongo.database instance
            collection = a pymongo.collection instance
+           dedup_mode = 'drop' to drop near-duplicate articles, 'link' to store them 
+                        with a 'duplicate_of' field pointing to the original or 'off'
+           dedup_threshold = a float min estimated similarity of near duplicates
+           dedup_collection = a Mongo collection string name storing article signatures
+           dedup = a NearDuplicateIndex instance, None if dedup_mode is 'off'
     '''
         
-    def __init__(self, mongo_uri, mongo_db, mongo_collection):
+    def __init__(self, mongo_uri, mongo_db, mongo_collection, 
+                 dedup_mode='drop', dedup_threshold=0.7, dedup_collection=None):
         '''Inits StackPipeline '''
         self.mongo_uri = mongo_uri
         self.mongo_collection = mongo_collection
         self.mongo_db = mongo_db
+        self.dedup_mode = dedup_mode
+        self.dedup_threshold = dedup_threshold
+        self.dedup_collection = dedup_collection or f'{mongo_collection}_minhash'
+    
+    @staticmethod
+    def dedup_settings(settings):
+        '''reads near-duplicate detection parameters from Scrapy settings'''
+        return dict(
+            dedup_mode = (settings.get('DEDUP_MODE') or 'drop').lower(),
+            dedup_threshold = settings.getfloat('DEDUP_THRESHOLD', 0.7),
+            dedup_collection = settings.get('DEDUP_COLLECTION')
+        )
     
         
     @classmethod
@@ -43,35 +71,291 @@ class StackPipeline(object):
         return cls(
             mongo_uri = crawler.settings.get('MONGO_URI'),
             mongo_db=crawler.settings.get('MONGODB_DB'),
-            mongo_collection=crawler.settings.get('MONGODB_COLLECTION')
+            mongo_collection=crawler.settings.get('MONGODB_COLLECTION'),
+            **cls.dedup_settings(crawler.settings)
         )
         
     def open_spider(self, spider):
-        '''instantiates MongoClient and attaches a custom
+        '''gets the shared MongoClient and attaches a custom
            class instance to the Scrapy spider.
             
            Args:
                 spider: a Scrapy.spider instance
         '''
         
-        self.client = pymongo.MongoClient(self.mongo_uri)
+        self.client = get_client(self.mongo_uri)
         self.db = self.client[self.mongo_db] 
         self.collection = self.db[self.mongo_collection]
+        self.dedup = None
+        if self.dedup_mode != 'off':
+            self.dedup = NearDuplicateIndex(self.db[self.dedup_collection], threshold=self.dedup_threshold)
         
-    def close_spider(self, spider):
-        '''closes MongoClient connection'''
-        self.client.close()
+    def deduplicate(self, doc):
+        '''assigns an id to an article and looks up its near duplicates 
+           among the stored ones. Original articles are added to the signature index.
+           
+           Raises:
+               DropItem: if the article is a near duplicate and dedup_mode is 'drop'
+        '''
+        
+        doc['_id'] = ObjectId()
+        if self.dedup is None:
+            return doc
+        original = self.dedup.check(doc['_id'], doc['article'])
+        if original is not None:
+            if self.dedup_mode == 'drop':
+                metrics.items_scraped.inc(outcome='duplicate')
+                raise DropItem (f"near duplicate of {original}: {doc['url']}")
+            doc['duplicate_of'] = original
+        return doc
         
     async def process_item(self, item, spider):
-        '''drops articles with no mention of stock tickers.
+        '''drops articles with no mention of stock tickers 
+           and near duplicates of stored articles.
            Places all others to the Mongo collection.
         '''
            
         tickers = ticker_extraction (item['article'])
         if tickers == []:
+            metrics.items_scraped.inc(outcome='dropped')
             raise DropItem (f"item with no news:{item}")
+        doc = self.deduplicate(ItemAdapter(item).asdict())
   
-        self.collection.insert_one(ItemAdapter(item).asdict())
+        with metrics.db_latency.time(stage='articles'):
+            self.collection.insert_one(doc)
+        metrics.db_writes.inc(stage='articles', op='insert')
+        metrics.items_scraped.inc(outcome='stored')
         return item
-    
 
+
+class StreamingPipeline(StackPipeline):
+    '''a Scrapy Pipeline class streaming each item through filtering,
+       ticker extraction, quote fetching and labelling in memory,
+       so that an article is written to Mongo DB once, already quoted and labelled.
+       
+       Stages are bounded: at most max_inflight items wait for Alpaca API at a time,
+       and at most queue_size processed items wait for the writer,
+       otherwise process_item blocks and Scrapy slows down the crawl.
+       The writer inserts articles and upserts their label rows in batches.
+       Articles reach the writer in the order their "_id" values were assigned,
+       whichever finishes fetching quotes first, so that readers resuming
+       above an "_id" watermark (follow mode, snapshots, checkpoints) never skip
+       an article committed late.
+       
+       Attributes:
+           field: a string name of a database field with historical stock quotes
+           label_collection: a string name of the collection labels are written to
+           events_collection: a string name of the collection per-ticker event rows are written to
+           threshold: a float label threshold (in per cents)
+           max_inflight: an integer max number of items fetching quotes at once
+           queue_size: an integer max number of items waiting to be written
+           batch_size: an integer max number of items written at once
+           meta_collection: a string name of the collection the sweeper bins are read from
+           bins: an array of sentence length bins saved by the last sweeper run, if any
+    '''
+    
+    def __init__(self, mongo_uri, mongo_db, mongo_collection, field, label_collection,
+                 threshold, max_inflight, queue_size, batch_size, meta_collection, events_collection=None, **dedup):
+        '''Inits StreamingPipeline '''
+        super().__init__(mongo_uri, mongo_db, mongo_collection, **dedup)
+        self.field = field
+        self.label_collection = label_collection
+        self.threshold = threshold
+        self.max_inflight = max_inflight
+        self.queue_size = queue_size
+        self.batch_size = batch_size
+        self.meta_collection = meta_collection
+        self.events_collection = events_collection or f'{mongo_collection}_events'
+        
+    @classmethod
+    def from_crawler(cls, crawler):
+        '''passes settings parameters to the __init__ method.
+        
+           Args:
+               crawler: a Scrapy.crawler instance
+        '''
+        s = crawler.settings
+        collection = s.get('MONGODB_COLLECTION')
+        return cls(
+            mongo_uri = s.get('MONGO_URI'),
+            mongo_db = s.get('MONGODB_DB'),
+            mongo_collection = collection,
+            field = s.get('QUOTES_FIELD', 'EVENT_STUDY'),
+            label_collection = s.get('LABEL_COLLECTION') or 'another_collection',
+            threshold = s.getfloat('LABEL_THRESHOLD', 2),
+            max_inflight = s.getint('STREAM_MAX_INFLIGHT', 10),
+            queue_size = s.getint('STREAM_QUEUE_SIZE', 100),
+            batch_size = s.getint('STREAM_BATCH_SIZE', 20),
+            meta_collection = s.get('MONGODB_META_COLLECTION') or f'{collection}_meta',
+            events_collection = s.get('EVENTS_COLLECTION'),
+            **cls.dedup_settings(s)
+        )
+    
+    def open_spider(self, spider):
+        '''connects to Mongo DB, loads the sweeper bins 
+           and starts the writer task.
+        '''
+        
+        super().open_spider(spider)
+        saved = self.db[self.meta_collection].find_one({"_id": "bins"})
+        self.bins = saved["bins"] if saved else None
+        if self.bins is None:
+            logger.info ("No sweeper bins saved, short articles are not filtered")
+        self.db[self.events_collection].create_index([('ticker', pymongo.ASCENDING), ('time', pymongo.ASCENDING)])
+        self.inflight = asyncio.Semaphore(self.max_inflight)
+        self.queue = asyncio.Queue(self.queue_size)
+        # ids in the order they were assigned, and processed articles waiting for earlier ones
+        self.order = deque()
+        self.ready = {}
+        self.emitting = asyncio.Lock()
+        self.writer = asyncio.ensure_future(self.write_loop())
+    
+    def close_spider(self, spider):
+        '''drains the writer queue'''
+        return deferred_from_coro(self.drain())
+    
+    async def drain(self):
+        await self.queue.put(None)
+        await self.writer
+    
+    def deduplicate(self, doc):
+        '''same as StackPipeline.deduplicate, recording the order ids are assigned in'''
+        doc = super().deduplicate(doc)
+        self.order.append(doc['_id'])
+        return doc
+    
+    async def emit(self, _id, doc):
+        '''passes a processed article to the writer after all articles given an earlier id.
+        
+           Args:
+               _id: the id assigned to the article
+               doc: the article document, None if it is not to be written
+        '''
+        
+        self.ready[_id] = doc
+        # a single emitter at a time, so that queue puts cannot overtake each other
+        async with self.emitting:
+            while self.order and self.order[0] in self.ready:
+                doc = self.ready.pop(self.order.popleft())
+                if doc is not None:
+                    await self.queue.put(doc)
+        metrics.queue_depth.set(self.queue.qsize(), stage='stream')
+    
+    async def process_item(self, item, spider):
+        '''drops articles with no mention of stock tickers,
+           articles composed from shortest sentences and near duplicates.
+           Requests quotes for all others and passes them to the writer.
+           Linked near duplicates are written without quotes.
+        '''
+        
+        doc = ItemAdapter(item).asdict()
+        # a ticker mentioned twice is quoted once, label rows are keyed by the article and the ticker
+        tickers = list(dict.fromkeys(ticker_extraction (doc['article'])))
+        if tickers == []:
+            metrics.items_scraped.inc(outcome='dropped')
+            raise DropItem (f"item with no news:{item}")
+        if self.bins is not None and is_short(doc['article'], self.bins):
+            metrics.items_scraped.inc(outcome='dropped')
+            raise DropItem (f"item with short sentences only:{item}")
+        doc = self.deduplicate(doc)
+        if 'duplicate_of' in doc:
+            await self.emit(doc['_id'], doc)
+            return item
+        
+        started = time.perf_counter()
+        try:
+            async with self.inflight:
+                # Alpaca instances keep the date of the request, so each item gets its own
+                inst = alp.Alpaca()
+                results = await asyncio.gather(*[inst.make_request(doc['time'], ticker=t) for t in tickers],
+                                               return_exceptions=True)
+        except BaseException:
+            # later articles must not wait for this one
+            await self.emit(doc['_id'], None)
+            raise
+        quotes = []
+        for r in results:
+            if isinstance(r, Exception):
+                logger.info ("Quotes not found: %s", r)
+            elif r is not None:
+                quotes.append(r)
+        if quotes:
+            doc[self.field] = quotes
+        metrics.doc_latency.observe(time.perf_counter()-started, stage='stream')
+        await self.emit(doc['_id'], doc)
+        metrics.items_scraped.inc(outcome='stored')
+        return item
+    
+    def label_rows(self, doc):
+        '''builds label rows of the same shape MongoHandler.merge_labels writes.
+        
+           Args:
+               doc: an article document with quotes
+           
+           Returns:
+               a list of dicts, one for each quoted ticker
+        '''
+        
+        rows = []
+        for quote in doc.get(self.field, []):
+            row = dict(doc)
+            row[self.field] = quote
+            row['label'] = label_of(quote[alp.Alpaca.returns], self.threshold)
+            row['_id'] = {'article': doc['_id'], 'ticker': quote['ticker']}
+            rows.append(row)
+        return rows
+    
+    def event_rows(self, doc):
+        '''builds event rows of the same shape MongoHandler.db_inserter writes'''
+        return [event_row(doc['_id'], doc.get('time'), quote, alp.Alpaca.returns, self.threshold)
+                for quote in doc.get(self.field, [])]
+    
+    def write_batch(self, batch):
+        '''inserts a batch of articles and upserts their label and event rows.
+        
+           Quoted articles are stamped with the server time, as MongoHandler.db_inserter
+           stamps them, since incremental labelling compares the stamps with the server clock.
+        '''
+        
+        stamp = self.field + '_updated'
+        with metrics.db_latency.time(stage='stream'):
+            articles = [pymongo.UpdateOne({'_id': doc['_id']},
+                                          [{'$replaceWith': {'$literal': doc}},
+                                           {'$set': {stamp: '$$NOW'}}], upsert=True)
+                        if self.field in doc else pymongo.InsertOne(doc) for doc in batch]
+            self.collection.bulk_write(articles, ordered=False)
+            # stamped with the server time, as MongoHandler.label_key does
+            labels = [pymongo.UpdateOne({'_id': row['_id']},
+                                        [{'$replaceWith': {'$literal': row}},
+                                         {'$set': {stamp: '$$NOW', 'labelled': '$$NOW'}}], upsert=True)
+                      for doc in batch for row in self.label_rows(doc)]
+            if labels:
+                self.db[self.label_collection].bulk_write(labels, ordered=False)
+            events = [pymongo.ReplaceOne({'_id': row['_id']}, row, upsert=True)
+                      for doc in batch for row in self.event_rows(doc)]
+            if events:
+                self.db[self.events_collection].bulk_write(events, ordered=False)
+        metrics.db_writes.inc(len(batch), stage='stream', op='insert')
+        metrics.db_writes.inc(len(labels) + len(events), stage='stream', op='upsert')
+        metrics.documents.inc(len(batch), stage='stream')
+    
+    async def write_loop(self):
+        '''takes processed items off the queue and writes them in batches 
+           in the executor until a None arrives.
+        '''
+        
+        loop = asyncio.get_event_loop()
+        done = False
+        while not done:
+            batch = [await self.queue.get()]
+            while len(batch) < self.batch_size and not self.queue.empty():
+                batch.append(self.queue.get_nowait())
+            if None in batch:
+                done = True
+                batch = [doc for doc in batch if doc is not None]
+            if not batch:
+                continue
+            try:
+                await loop.run_in_executor(None, self.write_batch, batch)
+            except Exception as e:
+                logger.exception ("An error occurred at write_loop: %s", e)
@@ -28,6 +28,20 @@ ITEM_PIPELINES = {'data_digger.stack.pipelines.StackPipeline':300}
 MONGO_URI = os.getenv('MONGO_URI')
 MONGODB_DB = os.getenv('MONGO_DB')
 MONGODB_COLLECTION = os.getenv('MONGODB_COLLECTION')
+MONGODB_META_COLLECTION = os.getenv('MONGODB_META_COLLECTION')
+LABEL_COLLECTION = os.getenv('LABEL_COLLECTION')
+LABEL_THRESHOLD = os.getenv('LABEL_THRESHOLD', 2)
+EVENTS_COLLECTION = os.getenv('EVENTS_COLLECTION')
+
+# Near-duplicate detection: 'drop', 'link' (stored with a 'duplicate_of' field) or 'off'
+DEDUP_MODE = os.getenv('DEDUP_MODE', 'drop')
+DEDUP_THRESHOLD = float(os.getenv('DEDUP_THRESHOLD', 0.7))
+DEDUP_COLLECTION = os.getenv('DEDUP_COLLECTION')
+
+# Bounds of StreamingPipeline stages (main.py --articles --stream)
+STREAM_MAX_INFLIGHT = 10
+STREAM_QUEUE_SIZE = 100
+STREAM_BATCH_SIZE = 20
 
 TWISTED_REACTOR = 'twisted.internet.asyncioreactor.AsyncioSelectorReactor'
 
@@ -45,7 +59,7 @@ USER_AGENT = 'Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:82.0) Gecko/20100101
 
 # Obey robots.txt rules
 ROBOTSTXT_OBEY = True
-# Disable logs as logging.basicConfig() is called from Mongo_module
+# Disable logs as logging is configured with data_digger.log_config from main.py
 LOG_ENABLED = False
 # Configure maximum concurrent requests performed by Scrapy (default: 16)
 CONCURRENT_REQUESTS = 1
@@ -0,0 +1,47 @@
+'''shared fixtures of the test suite.
+
+The package is installed as data_digger from the code directory,
+so code is mapped to that name when the tests run from a source checkout.
+
+Tests marked with the mongod fixture need a local MongoDB 4.2+ server,
+at MONGO_TEST_URI (mongodb://localhost:27017 by default), and are skipped without one.
+'''
+
+import importlib.util
+import os
+import sys
+import uuid
+from pathlib import Path
+
+import pytest
+
+CODE = Path(__file__).resolve().parent.parent / 'code'
+
+if importlib.util.find_spec('data_digger') is None:
+    spec = importlib.util.spec_from_file_location('data_digger', CODE / '__init__.py',
+                                                  submodule_search_locations=[str(CODE)])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['data_digger'] = module
+    spec.loader.exec_module(module)
+
+
+@pytest.fixture(scope='session')
+def mongod():
+    '''a MongoClient of a local mongod, the test is skipped if none is running'''
+    import pymongo
+    client = pymongo.MongoClient(os.getenv('MONGO_TEST_URI', 'mongodb://localhost:27017'),
+                                 serverSelectionTimeoutMS=1000)
+    try:
+        client.admin.command('ping')
+    except pymongo.errors.PyMongoError as e:
+        pytest.skip(f'no local mongod: {e}')
+    yield client
+    client.close()
+
+
+@pytest.fixture
+def test_db(mongod):
+    '''a fresh database dropped after the test'''
+    name = f'data_digger_test_{uuid.uuid4().hex[:8]}'
+    yield mongod[name]
+    mongod.drop_database(name)
@@ -0,0 +1,53 @@
+'''tests of the training dataset export resuming after relabelling.'''
+
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from bson import ObjectId
+
+from data_digger.exporter import DatasetExporter, load_dataset
+
+FIELD, RETURNS = 'EVENT_STUDY', 'abnormal returns'
+T0 = datetime(2026, 1, 1, 10)
+
+
+@pytest.fixture
+def labels():
+    coll = mongomock.MongoClient().db.labels
+    # mongomock lacks isMaster, the server clock is an hour after the last write
+    coll.database.command = lambda name: {'localTime': max(
+        [d['labelled'] for d in coll.find()], default=T0) + timedelta(hours=1)}
+    return coll
+
+
+def write(coll, article, ticker, label, car, labelled):
+    # what a labelling run writes, restamping the row
+    coll.replace_one({'_id': {'article': article, 'ticker': ticker}},
+                     {'article': 'Shares rose', 'time': T0, 'label': label, 'labelled': labelled,
+                      FIELD: {'ticker': ticker, RETURNS: car}}, upsert=True)
+
+
+def test_relabelled_rows_are_exported_once(labels, tmp_path):
+    a, b = ObjectId(), ObjectId()
+    write(labels, a, 'AAPL', '1', 3.0, T0)
+    write(labels, b, 'MSFT', '0', 0.5, T0)
+    exporter = DatasetExporter(str(tmp_path), n_features=64, settle=60)
+    assert exporter.export(labels, FIELD, RETURNS) == 2
+
+    # relabelled unchanged, and a new ticker of an older article
+    write(labels, a, 'AAPL', '1', 3.0, T0 + timedelta(hours=1))
+    write(labels, a, 'TSLA', '0', 1.0, T0 + timedelta(hours=1))
+    assert DatasetExporter(str(tmp_path), n_features=64, settle=60).export(labels, FIELD, RETURNS) == 1
+
+    # relabelled with another threshold
+    write(labels, b, 'MSFT', '1', 0.5, T0 + timedelta(hours=2))
+    assert DatasetExporter(str(tmp_path), n_features=64, settle=60).export(labels, FIELD, RETURNS) == 1
+
+    data = load_dataset(str(tmp_path))
+    assert data['rows'] == 4
+    assert data['superseded'].tolist() == [0, 1, 0, 0]
+    live = data['superseded'] == 0
+    assert sorted(zip(data['ticker'][live].tolist(), data['labels'][live].tolist())) == \
+        [(b'AAPL', 1), (b'MSFT', 1), (b'TSLA', 0)]
+    assert data['article_id'][3].tobytes() == b.binary
@@ -0,0 +1,102 @@
+'''tests of the document leases shared by --quotes workers.'''
+
+import threading
+from datetime import datetime, timedelta
+
+import mongomock
+import pytest
+from pymongo.collection import Collection
+
+from data_digger.checkpoint import Checkpoint
+from data_digger.Mongo_module import MongoHandler
+
+FIELD = 'EVENT_STUDY'
+
+
+def handler(db):
+    return MongoHandler(FIELD, client=db.client, db=db.name, collection='articles')
+
+
+def insert_articles(db, n):
+    docs = [{'article': f'article {i}', 'time': datetime(2020, 10, 8, 10)} for i in range(n)]
+    return db.articles.insert_many(docs).inserted_ids
+
+
+def test_concurrent_workers_claim_each_document_once(test_db):
+    ids = insert_articles(test_db, 300)
+    workers = [handler(test_db) for _ in range(8)]
+    claimed = {w.owner: [] for w in workers}
+
+    def work(w):
+        for batch in iter(lambda: w.claim_batch(10), []):
+            claimed[w.owner].extend(a._id for a in batch)
+
+    threads = [threading.Thread(target=work, args=(w,)) for w in workers]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(30)
+    got = [i for c in claimed.values() for i in c]
+    assert len(got) == len(set(got))
+    assert set(got) == set(ids)
+
+
+def test_lost_race_claims_the_next_documents(test_db, monkeypatch):
+    ids = insert_articles(test_db, 20)
+    winner, loser = handler(test_db), handler(test_db)
+    update_many = Collection.update_many
+
+    def racing(self, *args, **kwargs):
+        # the winner leases the same candidates between the loser's read and update
+        monkeypatch.setattr(Collection, 'update_many', update_many)
+        assert [a._id for a in winner.claim_batch(10)] == ids[:10]
+        return update_many(self, *args, **kwargs)
+
+    monkeypatch.setattr(Collection, 'update_many', racing)
+    assert [a._id for a in loser.claim_batch(10)] == ids[10:]
+
+
+def test_expired_lease_is_reclaimed(test_db):
+    ids = insert_articles(test_db, 1)
+    crashed, other = handler(test_db), handler(test_db)
+    assert crashed.claim_batch(1)
+    assert other.claim_batch(1) == []
+    test_db.articles.update_one({'_id': ids[0]},
+                                {'$set': {'lease.expires': datetime.utcnow() - timedelta(seconds=1)}})
+    assert [a._id for a in other.claim_batch(1)] == ids
+
+
+def test_takeover_claims_live_leases_of_an_owner(test_db):
+    ids = insert_articles(test_db, 2)
+    crashed, live, resumed = handler(test_db), handler(test_db), handler(test_db)
+    crashed.claim_batch(1)
+    live.claim_batch(1)
+    claimed = resumed.claim_batch(2, {'_id': {'$in': ids}}, takeover=crashed.owner)
+    assert [a._id for a in claimed] == ids[:1]
+
+
+def test_released_document_is_not_retried_immediately(test_db):
+    insert_articles(test_db, 1)
+    worker = handler(test_db)
+    item = worker.claim_batch(1)[0]
+    worker.release(item)
+    assert worker.claim_batch(1) == []
+    lease = test_db.articles.find_one({'_id': item._id})['lease']
+    assert lease['owner'] is None
+
+
+def test_consumers_are_stopped_when_the_producer_fails():
+    worker = MongoHandler(FIELD, client=mongomock.MongoClient(), db='test', collection='articles')
+
+    def fail(*args, **kwargs):
+        raise RuntimeError('claim failed')
+
+    worker.claim_batch = fail
+    q = []
+    lock = threading.Lock()
+    full, empty = threading.Condition(lock), threading.Condition(lock)
+    checkpoint = Checkpoint(worker.meta, 'quotes:test')
+    worker.find_item(q, full, empty, checkpoint=checkpoint)
+    assert q == [None] * 10
+    # the resume position is kept
+    assert checkpoint.failed
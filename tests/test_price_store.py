@@ -0,0 +1,32 @@
+'''tests of the event windows read from the local price store.'''
+
+from datetime import date, timedelta
+
+import pandas as pd
+import pytest
+
+from benchmarks.stubs import daily_bars
+from data_digger.price_store import PriceStore
+
+FIRST, LAST = date(2020, 8, 3), date(2020, 10, 30)
+
+
+@pytest.fixture
+def store(tmp_path):
+    bars = [dict(bar, symbol=s) for s in ('AAPL', 'SPY') for bar in daily_bars(s, FIRST, LAST)]
+    pd.DataFrame(bars).to_csv(tmp_path / 'bars.csv', index=False)
+    store = PriceStore(str(tmp_path / 'store'))
+    store.import_csv([str(tmp_path / 'bars.csv')])
+    return store
+
+
+@pytest.mark.parametrize('start, end', [(date(2020, 10, 7), date(2020, 10, 8)),
+                                        (date(2020, 10, 8), date(2020, 10, 9)),
+                                        (date(2020, 10, 9), date(2020, 10, 12))])
+def test_event_windows_match_the_api(store, start, end):
+    before, after = store.event_windows('AAPL', start, end)
+    for s in ('AAPL', 'SPY'):
+        # the bars AlpacaStub answers until=start&limit=30 and start=start&end=end with
+        assert before[s] == daily_bars(s, start - timedelta(days=60), start)[-30:]
+        assert after[s] == daily_bars(s, start, end)
+    assert [b['t'] for b in after['AAPL']][0] == before['AAPL'][-1]['t']
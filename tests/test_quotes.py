@@ -0,0 +1,38 @@
+'''tests of the quotes stage writing one quote per ticker of an article.'''
+
+import asyncio
+from datetime import datetime
+
+import mongomock
+
+from data_digger import Alpaca as alp
+from data_digger.Mongo_module import MongoHandler
+
+FIELD = 'EVENT_STUDY'
+TEXT = ('Apple (NASDAQ:AAPL) and Microsoft (NASDAQ:MSFT) rose. '
+        'Apple (AAPL +1.8%) led the gains. Shares of both closed higher.')
+
+
+class FakeAlpaca:
+    def __init__(self):
+        self.requested = []
+
+    async def make_request(self, date, ticker):
+        self.requested.append(ticker)
+        return {'ticker': ticker, alp.Alpaca.returns: 3.0, 'alpha': 0.0, 'beta': 1.0}
+
+
+def test_repeated_ticker_is_quoted_and_labelled_once():
+    handler = MongoHandler(FIELD, client=mongomock.MongoClient(), db='test', collection='articles')
+    coll = handler.db['articles']
+    _id = coll.insert_one({'article': TEXT, 'time': datetime(2020, 10, 8, 10)}).inserted_id
+    inst, loop = FakeAlpaca(), asyncio.new_event_loop()
+    try:
+        handler.process_item(coll.find_one({'_id': _id}), inst, loop)
+    finally:
+        loop.close()
+    assert inst.requested == ['AAPL', 'MSFT']
+    # the keys the "$out" rebuild writes must be unique
+    key = {'$set': {'_id': handler.label_key()['$set']['_id']}}
+    rows = list(coll.aggregate(handler.label_stages(2) + [key]))
+    assert sorted(r['_id']['ticker'] for r in rows) == ['AAPL', 'MSFT']